@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+import requests
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from mdb.captcha import CaptchaSolver, CaptchaService, CaptchaError
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+captcha_page = '''<html><body>
+<div class="captcha__image"><img src="%(base)s/captcha.png"></div>
+<input class="form__key" value="%(key)s">
+<input class="form__retpath" value="%(base)s/film/1/">
+</body></html>'''
+
+
+class FakeSolver(object):
+    """
+    Stand-in for anti-captcha API (createTask and getTaskResult) and for the
+    captcha pages of the site (/captcha.png and /checkcaptcha). A task is
+    solved `delay` seconds after it was created, /checkcaptcha accepts only
+    the solution returned by the API.
+    """
+
+    def __init__(self, key='fake-key', solution='solution', delay=1):
+        self.key = key
+        self.solution = solution
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.tasks = dict()
+        self.checks = 0
+
+    def create_task(self, data):
+        if data.get('clientKey') != self.key:
+            return {'errorId': 1, 'errorDescription': 'ERROR_KEY_DOES_NOT_EXIST'}
+        with self.lock:
+            task_id = len(self.tasks) + 1
+            self.tasks[task_id] = time.time()
+        return {'errorId': 0, 'taskId': task_id}
+
+    def get_task_result(self, data):
+        created = self.tasks.get(data.get('taskId'))
+        if created is None:
+            return {'errorId': 16, 'errorDescription': 'ERROR_NO_SUCH_CAPCHA_ID'}
+        if time.time() - created < self.delay:
+            return {'errorId': 0, 'status': 'processing'}
+        return {'errorId': 0, 'status': 'ready', 'solution': {'text': self.solution}}
+
+    def check(self, params):
+        with self.lock:
+            self.checks += 1
+        return params.get('rep') == [self.solution]
+
+    def serve(self, port=0, host='127.0.0.1'):
+        """
+        Starts HTTP server in a background thread, returns its base URL
+        """
+        solver = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def send(self, status, body, content_type):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                methods = {'/createTask': solver.create_task,
+                           '/getTaskResult': solver.get_task_result}
+                if self.path not in methods:
+                    self.send_error(404)
+                    return
+                data = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                self.send(200, json.dumps(methods[self.path](data)).encode('utf-8'),
+                          'application/json')
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path == '/captcha.png':
+                    self.send(200, b'\x89PNG fake image', 'image/png')
+                elif url.path == '/checkcaptcha' and solver.check(parse_qs(url.query)):
+                    self.send(200, b'<html>OK</html>', 'text/html')
+                elif url.path == '/checkcaptcha':
+                    self.send_error(403)
+                else:
+                    self.send_error(404)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return 'http://%s:%s' % server.server_address
+
+
+class App():
+    """
+    Runs the fake anti-captcha service, with --check drives CaptchaSolver
+    and CaptchaService against it and exits with non-zero status on failure
+    """
+
+    def __init__(self):
+        parser = argparse.ArgumentParser(description='Fake anti-captcha service')
+        parser.add_argument('--port', required=False, default=0, type=int)
+        parser.add_argument('--delay', required=False, default=1, type=float,
+                            help='Time in seconds a task takes to be solved')
+        parser.add_argument('--check', required=False, default=False, action='store_true')
+        self.args = parser.parse_args()
+        self.solver = FakeSolver(delay=self.args.delay)
+
+    def check(self, base):
+        CaptchaSolver.first_delay = 0.2
+        assert CaptchaSolver(base, self.solver.key).solve(b'image') == self.solver.solution
+        try:
+            CaptchaSolver(base, 'wrong-key').solve(b'image')
+            raise AssertionError('Task with wrong key was created')
+        except CaptchaError:
+            pass
+        # Одна и та же капча решается один раз, разные капчи одной сессии решаются
+        # параллельно
+        service = CaptchaService.Instance()
+        service.configure(base, self.solver.key)
+        session = requests.Session()
+        pages = [captcha_page % {'base': base, 'key': key} for key in ('a', 'a', 'a', 'b')]
+        start = time.time()
+        futures = [service.solve(session, base + '/film/1/', page) for page in pages]
+        for future in futures:
+            future.result()
+        assert self.solver.checks == 2, 'captcha was submitted %s times' % self.solver.checks
+        assert time.time() - start < self.args.delay * 2, 'captchas were solved one by one'
+        print('OK')
+
+    def run(self):
+        base = self.solver.serve(self.args.port)
+        if self.args.check:
+            self.check(base)
+            return
+        print('Anti-captcha API is available at %s' % base)
+        while True:
+            time.sleep(3600)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(message)s', level=logging.WARNING, stream=sys.stdout)
+    logging.disable(logging.INFO)
+    app = App()
+    app.run()
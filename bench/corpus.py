@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+
+"""
+Fixture corpus for benchmarks: synthetic pages in the layout the parsers
+expect. Pages are checked in to bench/fixtures, run this module to
+regenerate them after the generator is changed.
+"""
+
+import os
+import time
+
+from parselab.network import NetworkManager, PageNotFound
+
+base = 'https://www.kinopoisk.ru'
+path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+year = 2010
+
+# Фильмы корпуса: небольшой, с огромным составом и с датами премьер и сборами
+films = {101: {'full_id': '101', 'title': 'Короткий метр',
+               'roles': {'director': 1, 'actor': 4}},
+         102: {'full_id': 'bolshoy-sostav-2010-102', 'title': 'Большой состав',
+               'roles': {'director': 3, 'writer': 6, 'producer': 12, 'operator': 2,
+                         'composer': 1, 'design': 5, 'editor': 2, 'voice': 20, 'actor': 250}},
+         103: {'full_id': 'premiery-i-sbory-2010-103', 'title': 'Премьеры и сборы',
+               'roles': {'director': 2, 'writer': 3, 'producer': 4, 'actor': 40},
+               'dates': 60, 'boxes': 8}}
+
+persons = {1001: {'name': 'Актёр Живой', 'birth': '1970-03-15', 'growth': '1.82 м'},
+           1002: {'name': 'Актёр Покойный', 'birth': '1910-11-02', 'growth': '1.75 м',
+                  'death': '4 июня 1980 • 69 лет'}}
+
+role_titles = {'director': 'режиссер', 'writer': 'сценарий', 'producer': 'продюсер',
+               'operator': 'оператор', 'composer': 'композитор', 'design': 'художник',
+               'editor': 'монтаж'}
+
+roles = ['actor', 'composer', 'design', 'director', 'editor', 'operator', 'producer', 'voice',
+         'writer']
+
+months = ['января', 'февраля', 'марта', 'апреля', 'мая', 'июня', 'июля', 'августа',
+          'сентября', 'октября', 'ноября', 'декабря']
+
+
+def chrome(body):
+    """
+    Wraps page content into navigation, scripts and footer, so that pages
+    are about as large as real ones
+    """
+    menu = ''.join('<li><a href="/lists/navigator/%s/">Раздел %s</a></li>' % (i, i)
+                   for i in range(300))
+    script = '<script>var data = "%s";</script>' % ('x' * 10000)
+    return ('<html><head><title>КиноПоиск</title>%s</head><body><div id="header"><ul>%s</ul>'
+            '</div><div id="content">%s</div><div id="footer"><ul>%s</ul></div></body></html>'
+            % (script, menu, body, menu))
+
+
+def person_id(film_id, role, number):
+    return film_id * 10000 + roles.index(role) * 1000 + number
+
+
+def main_page(id):
+    film = films[id]
+    info = [('год', '<a href="/lists/m_act[year]/%s/">%s</a>' % (year, year)),
+            ('страна', '<a href="/lists/navigator/country-1/">США</a>, '
+                       '<a href="/lists/m_act[country]/2/">Канада</a>'),
+            ('слоган', '«Слоган фильма %s»' % id)]
+    for role, title in sorted(role_titles.items()):
+        count = film['roles'].get(role, 0)
+        if count > 0:
+            info.append((title, ', '.join('<a href="/name/%s/">Персона %s</a>'
+                                          % (person_id(id, role, i), i)
+                                          for i in range(min(count, 4)))))
+    info += [('жанр', '<a href="/lists/navigator/drama/">драма</a>, '
+                      '<a href="/lists/navigator/comedy/">комедия</a>'),
+             ('время', '%s мин. / 01:%02d' % (60 + id % 60, id % 60)),
+             ('возраст', '<span>16+</span>'),
+             ('премьера (мир)', '<div class="prem_ical" data-ical-type="world" '
+                                'data-ical-date="12 мая %s"></div>' % year),
+             ('премьера (РФ)', '<div class="prem_ical" data-ical-type="rus" '
+                               'data-ical-date="3 июня %s"></div>' % year),
+             ('рейтинг MPAA', '<img alt="рейтинг PG-13"/>')]
+    rows = ''.join('<tr><td class="type">%s</td><td>%s</td></tr>' % item for item in info)
+    return chrome('<div class="subscribe"><div class="link"><a href="/film/%s/subscribe/">'
+                  'Подписаться</a></div></div><h1 class="moviename-big">%s</h1>'
+                  '<span itemprop="alternativeHeadline">Film %s</span>'
+                  '<table class="info">%s</table>'
+                  '<span class="rating_ball">7.512</span>'
+                  '<span class="ratingCount">12&nbsp;345</span>'
+                  '<div id="block_rating"><div>IMDb: 7.10 (1 234)</div></div>'
+                  '<div class="criticsRating"><div class="star">6.5</div></div>'
+                  % (film['full_id'], film['title'], id, rows))
+
+
+def person_div(id, number):
+    return ('<div class="dub"><div class="info"><div class="name"><a href="/name/%s/">'
+            'Персона %s</a><span class="gray">Person %s</span></div>'
+            '<div class="role">... Роль %s</div></div></div>' % (id, number, number, number))
+
+
+def cast_list(id, role, numbers):
+    return ''.join(person_div(person_id(id, role, i), i) for i in numbers)
+
+
+def role_block(id, role, numbers):
+    return '<a name="%s"></a><div>%s</div>%s<br/>' % (role, role, cast_list(id, role, numbers))
+
+
+def cast_pages(id):
+    """
+    Returns cast pages of the film as {url: page}: a single cast page for
+    small films, a page per role and the second page of actors otherwise
+    """
+    counts = films[id]['roles']
+    url = '%s/film/%s/cast/' % (base, id)
+    if sum(counts.values()) < 100:
+        return {url: chrome(''.join(role_block(id, role, range(count))
+                                    for role, count in sorted(counts.items())))}
+    links = ''.join('<a class="all" href="/film/%s/cast/who_is/%s/">все</a>' % (id, role)
+                    for role in sorted(counts) if role != 'actor')
+    pages = {url: chrome('<table><tr><td class="anchers">%s</td></tr></table>%s'
+                         % (links, role_block(id, 'actor', range(10))))}
+    for role, count in counts.items():
+        pages['%swho_is/%s/' % (url, role)] = chrome(role_block(id, role, range(min(count, 100))))
+        if count > 100:
+            pages['%swho_is/%s/:10000' % (url, role)] = chrome(cast_list(id, role,
+                                                                         range(100, count)))
+    return pages
+
+
+def dates_page(id):
+    rows = ''
+    for i in range(films[id].get('dates', 0)):
+        rows += ('<tr><td><div class="flag flag%s"></div></td><td><a>%s %s %s</a></td>'
+                 '<td><a class="all" href="/lists/m_act[country]/%s/">Страна %s</a>'
+                 '<small>%s</small></td><td><small>%s чел.</small></td></tr>'
+                 % (i, i % 28 + 1, months[i % 12], year + i // 12, i + 1, i + 1,
+                    'фестиваль' if i % 5 == 0 else '', '{:,}'.format(i * 1000).replace(',', ' ')))
+    return chrome('<table>%s</table>' % rows)
+
+
+def box_page(id):
+    rows = '<tr><td>Бюджет</td></tr>'
+    for i in range(films[id].get('boxes', 0)):
+        rows += ('<tr><td colspan="2"><b>Сборы %s:</b></td></tr><tr><td>$%s</td></tr>'
+                 % (i, '{:,}'.format((i + 1) * 1250000).replace(',', ' ')))
+    return chrome('<div style="width: 274px"><table>%s</table></div>' % rows)
+
+
+def person_page(id):
+    person = persons[id]
+    info = ('<tr><td class="type">дата рождения</td><td class="birth" birthdate="%s">%s</td></tr>'
+            '<tr><td class="type">место рождения</td><td>Москва, СССР</td></tr>'
+            '<tr><td class="type">рост</td><td>%s</td></tr>'
+            % (person['birth'], person['birth'], person['growth']))
+    if 'death' in person:
+        info += ('<tr><td class="type">дата смерти</td><td>%s</td></tr>'
+                 '<tr><td class="type">место смерти</td><td>Ленинград, СССР</td></tr>'
+                 % person['death'])
+    return chrome('<h1>%s</h1><span itemprop="alternateName">Person %s</span>'
+                  '<table class="info">%s</table>' % (person['name'], id, info))
+
+
+def listing_page(page, pages):
+    items = ''
+    for i in range(50):
+        id = sorted(films)[(page * 50 + i) % len(films)]
+        items += ('<div class="selections-film-item"><a class="selection-film-item-meta__link" '
+                  'href="/film/%s/"><p class="selection-film-item-meta__name">%s</p></a></div>'
+                  % (films[id]['full_id'], films[id]['title']))
+    return chrome('<div class="selections-seo-page__meta-info">%s фильмов</div>%s'
+                  '<div class="paginator"><a class="paginator__page-number">1</a>'
+                  '<a class="paginator__page-number">%s</a></div>' % (pages * 50, items, pages))
+
+
+def get_pages():
+    """
+    Returns all pages of the corpus as {url: (page type, page)}
+    """
+    pages = dict()
+    for id in films:
+        pages['%s/film/%s/' % (base, id)] = ('film', main_page(id))
+        for url, page in cast_pages(id).items():
+            pages[url] = ('who_is' if '/who_is/' in url else 'cast', page)
+        if 'dates' in films[id]:
+            pages['%s/film/%s/dates/' % (base, films[id]['full_id'])] = ('dates', dates_page(id))
+        if 'boxes' in films[id]:
+            pages['%s/film/%s/box/' % (base, films[id]['full_id'])] = ('box', box_page(id))
+    for id in persons:
+        pages['%s/name/%s/' % (base, id)] = ('person', person_page(id))
+    for page in range(1, 3):
+        pages['%s/lists/navigator/%s/?page=%s' % (base, year, page)] = ('listing',
+                                                                       listing_page(page, 2))
+    return pages
+
+
+def get_filename(number, page_type):
+    return '%03d-%s.html' % (number, page_type)
+
+
+def write():
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, 'index.txt'), 'w') as index:
+        for number, (url, (page_type, page)) in enumerate(sorted(get_pages().items())):
+            filename = get_filename(number, page_type)
+            with open(os.path.join(path, filename), 'w') as f:
+                f.write(page)
+            index.write('%s\t%s\t%s\n' % (url, page_type, filename))
+
+
+def load():
+    """
+    Reads checked in corpus, returns {url: (page type, page)}
+    """
+    pages = dict()
+    with open(os.path.join(path, 'index.txt')) as index:
+        for line in index:
+            url, page_type, filename = line.rstrip('\n').split('\t')
+            with open(os.path.join(path, filename)) as f:
+                pages[url] = (page_type, f.read())
+    return pages
+
+
+class CorpusCache(object):
+    """
+    Page cache which serves corpus pages and never stores anything,
+    so every page is requested from the network manager
+    """
+
+    def is_in_cache(self, url):
+        return False
+
+    def is_in_cache_error(self, url):
+        return False
+
+    def write_to_cache(self, url, data, binary=False):
+        pass
+
+    def get_cached_filename(self, url):
+        return None
+
+
+class CorpusNetworkManager(NetworkManager):
+    """
+    Network manager which returns corpus pages after a simulated delay
+    """
+
+    def __init__(self, pages, latency=0):
+        self.proxies = {}
+        self.pages = pages
+        self.latency = latency
+
+    def download_page(self, url, *args, **kwargs):
+        data = kwargs.get('data') or dict()
+        if 'start_list' in data:
+            url = '%s:%s' % (url, data['start_list'])
+        if self.latency > 0:
+            time.sleep(self.latency)
+        if url not in self.pages:
+            raise PageNotFound('Page "%s" is not in the corpus' % url)
+        return self.pages[url][1]
+
+    def post_page(self, url, data):
+        return self.download_page(url, data=data)
+
+
+if __name__ == '__main__':
+    write()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+
+import sys
+import time
+import logging
+import argparse
+
+from mdb.film import Film
+from mdb.cache import get_cache
+from mdb.network import OfflineNetworkManager
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class MemoryCache(object):
+    """
+    Keeps pages read from the page cache in memory, so that repeated
+    parsing measures CPU cost only
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.pages = dict()
+
+    def is_in_cache(self, url):
+        return url in self.pages or self.cache.is_in_cache(url)
+
+    def is_in_cache_error(self, url):
+        return False
+
+    def get_file(self, url, binary=False):
+        if url not in self.pages:
+            self.pages[url] = self.cache.get_file(url)
+        return self.pages[url]
+
+
+class App():
+    """
+    Measures how many films per second are parsed from the page cache,
+    pages are read once and parsed --repeat times from memory
+    """
+
+    def __init__(self):
+        parser = argparse.ArgumentParser(description='Film parsing benchmark')
+        parser.add_argument('--from-id', required=False, default=1, type=int)
+        parser.add_argument('--to-id', required=False, default=None, type=int,
+                            help='Last film ID, defaults to all films from the cache manifest')
+        parser.add_argument('--limit', required=False, default=1000, type=int,
+                            help='Max number of films')
+        parser.add_argument('--repeat', required=False, default=5, type=int)
+        self.args = parser.parse_args()
+        self.cache = MemoryCache(get_cache())
+        self.net = OfflineNetworkManager()
+
+    def get_film_ids(self):
+        if self.args.to_id is not None:
+            ids = range(self.args.from_id, self.args.to_id + 1)
+        else:
+            ids = self.cache.cache.manifest.get_film_ids(self.args.from_id)
+        result = list()
+        for id in ids:
+            if self.cache.is_in_cache(self.get_film_url(id)):
+                result.append(id)
+                if len(result) == self.args.limit:
+                    break
+        return result
+
+    def get_film_url(self, id):
+        return 'https://www.kinopoisk.ru/film/%s/' % id
+
+    def parse(self, ids):
+        count = 0
+        for id in ids:
+            try:
+                Film(id, self.cache.get_file(self.get_film_url(id)),
+                     cache=self.cache, net=self.net)
+                count += 1
+            except Exception as e:
+                logger.debug('Could not parse film %s: %s' % (id, str(e),))
+        return count
+
+    def run(self):
+        ids = self.get_film_ids()
+        if not ids:
+            raise Exception('There are no cached films to parse')
+        # Первый проход читает страницы в память и не учитывается
+        self.parse(ids)
+        times = list()
+        for i in range(self.args.repeat):
+            start = time.perf_counter()
+            count = self.parse(ids)
+            times.append(time.perf_counter() - start)
+        best = min(times)
+        print('%s films, best of %s runs: %.3f s, %.1f films/s, %.2f ms per film'
+              % (count, self.args.repeat, best, count / best, best * 1000 / count,))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(message)s', level=logging.WARNING, stream=sys.stdout)
+    # Модули mdb пишут в лог каждый шаг разбора, это не должно влиять на замер
+    logging.disable(logging.WARNING)
+    app = App()
+    app.run()
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+
+import os
+import sys
+import time
+import logging
+import argparse
+
+from lxml.html import fromstring
+
+from bench import corpus
+from mdb.db import Database
+from mdb.film import Film
+from mdb.person import Person
+from mdb.crawler import AsyncCrawler
+from mdb.writer import FilmWriter
+
+db = Database.Instance()
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# Фильмы, сохраняемые при замере записи, получают ID из этого диапазона
+save_base_id = 2000000000
+
+
+class Crawl(object):
+    """
+    Stand-in for App in AsyncCrawler: films are built from the corpus
+    through the network manager stub and are not saved
+    """
+
+    def __init__(self, pages, latency, film_workers):
+        self.pages = pages
+        self.latency = latency
+        self.film_workers = film_workers
+        self.count = 0
+        self.errors = 0
+
+    def get_film(self, id):
+        net = corpus.CorpusNetworkManager(self.pages, self.latency)
+        page = net.download_page('%s/film/%s/' % (corpus.base, id))
+        return Film(id, page, workers=self.film_workers, cache=corpus.CorpusCache(), net=net)
+
+    def save_film(self, film):
+        self.count += 1
+
+    def log_error(self, id, message):
+        logger.error('Could not parse film %s: %s' % (id, message,))
+        self.errors += 1
+
+
+class App():
+    """
+    Benchmark suite on the fixture corpus from bench/fixtures. Reports parse
+    time per page type, films per second for the whole crawl with stubbed
+    network and, if a database is given, rows per second written by
+    Film.save() and FilmWriter
+    """
+
+    def __init__(self):
+        parser = argparse.ArgumentParser(description='Benchmark suite')
+        parser.add_argument('--repeat', required=False, default=20, type=int,
+                            help='Number of runs, the best one is reported')
+        parser.add_argument('--films', required=False, default=100, type=int,
+                            help='Number of films in the crawl and save benchmarks')
+        parser.add_argument('--latency', required=False, default=0, type=float,
+                            help='Simulated network latency in seconds for the crawl benchmark')
+        parser.add_argument('--concurrency', required=False, default=1, type=int)
+        parser.add_argument('--film-workers', required=False, default=1, type=int)
+        parser.add_argument('--dsn', required=False, default=os.environ.get('BENCH_DSN'),
+                            help='Throwaway database created from install.sql, defaults to '
+                                 'BENCH_DSN, the save benchmark is skipped without it')
+        parser.add_argument('--only', required=False, default=None,
+                            choices=['parse', 'crawl', 'save'])
+        self.args = parser.parse_args()
+        self.pages = corpus.load()
+        self.net = corpus.CorpusNetworkManager(self.pages)
+
+    def measure(self, function, repeat=None):
+        """
+        Returns the best time of `repeat` calls of the function
+        """
+        times = list()
+        for i in range(repeat or self.args.repeat):
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    def report(self, name, seconds, count, unit):
+        print('%-24s %10.2f ms %12.1f %s/s' % (name, seconds * 1000, count / seconds, unit,))
+
+    def get_film(self, id, workers=1):
+        page = self.net.download_page('%s/film/%s/' % (corpus.base, id))
+        return Film(id, page, workers=workers, cache=corpus.CorpusCache(), net=self.net)
+
+    def get_urls(self, page_type):
+        return [url for url, (type, page) in sorted(self.pages.items()) if type == page_type]
+
+    def reset(self, film):
+        film.countries, film.countries_to_save, film.persons, film.genres = [], [], [], []
+        film.premieres, film.ratings, film.dates, film.boxes, film.cast = [], [], [], [], []
+
+    def benchmark_parse(self):
+        """
+        Parse time of every page type, pages are taken from memory
+        """
+        print('Parse time per page type (best of %s runs)' % self.args.repeat)
+        films = [self.get_film(id) for id in sorted(corpus.films)]
+
+        def parse_main():
+            for film in films:
+                self.reset(film)
+                film.html = fromstring(film.buffer)
+                film.parse_title()
+                film.parse_info()
+                film.get_ratings()
+                film.get_production_status()
+
+        def parse_cast(page_type):
+            for url in self.get_urls(page_type):
+                if ':' in url.split('/')[-1]:
+                    continue
+                film = films[sorted(corpus.films).index(int(url.split('/')[4]))]
+                self.reset(film)
+                film.extract_people_from_cast_page(url, check_pages=page_type == 'who_is')
+
+        def parse_dates():
+            for film in films:
+                if film.get_dates_url() in self.pages:
+                    self.reset(film)
+                    film.get_dates()
+
+        def parse_boxes():
+            for film in films:
+                if film.get_boxes_url() in self.pages:
+                    self.reset(film)
+                    film.get_boxes()
+
+        person = Person(0, self.pages[self.get_urls('person')[0]][1],
+                        cache=corpus.CorpusCache(), net=self.net)
+
+        def parse_persons():
+            for url in self.get_urls('person'):
+                person.parse(self.pages[url][1])
+
+        def parse_listings():
+            for url in self.get_urls('listing'):
+                html = fromstring(self.pages[url][1])
+                [item.get('href') for item in find_film_links(html)]
+
+        # Разбор списков живёт в parser.py, который требует config.py
+        try:
+            from parser import find_film_links
+        except ImportError:
+            find_film_links = None
+
+        for name, function, count in (
+                ('film', parse_main, len(films)),
+                ('cast', lambda: parse_cast('cast'), len(self.get_urls('cast'))),
+                ('who_is', lambda: parse_cast('who_is'), len(self.get_urls('who_is'))),
+                ('dates', parse_dates, len(self.get_urls('dates'))),
+                ('box', parse_boxes, len(self.get_urls('box'))),
+                ('person', parse_persons, len(self.get_urls('person'))),
+                ('listing', parse_listings, len(self.get_urls('listing')))):
+            if name == 'listing' and find_film_links is None:
+                print('%-24s skipped, config.py is missing' % name)
+                continue
+            self.report(name, self.measure(function) / count, 1, 'pages')
+
+    def get_film_ids(self):
+        ids = sorted(corpus.films)
+        return [ids[i % len(ids)] for i in range(self.args.films)]
+
+    def benchmark_crawl(self):
+        """
+        Films per second from listing to parsed film, network is stubbed
+        """
+        print('Crawl of %s films, latency %s s, concurrency %s, film workers %s'
+              % (self.args.films, self.args.latency, self.args.concurrency,
+                 self.args.film_workers,))
+        crawl = Crawl(self.pages, self.args.latency, self.args.film_workers)
+        films = [(id, '', '') for id in self.get_film_ids()]
+
+        def run():
+            if self.args.concurrency > 1:
+                AsyncCrawler(crawl, self.args.concurrency).run(iter(films))
+            else:
+                for id, title, href in films:
+                    crawl.save_film(crawl.get_film(id))
+
+        repeat = 1 if self.args.latency > 0 else max(self.args.repeat // 5, 1)
+        self.report('crawl', self.measure(run, repeat), len(films), 'films')
+        if crawl.errors > 0:
+            raise Exception('%s films failed' % crawl.errors)
+
+    def get_rows_count(self, film):
+        return (1 + len(film.get_persons_rows()) + len(film.get_cast_rows()) +
+                len(film.get_ratings_rows()) + len(film.get_premieres_rows()) +
+                len(film.get_dates_rows()) + len(film.get_boxes_rows()))
+
+    def benchmark_save(self):
+        """
+        Rows per second written into the database by Film.save() and FilmWriter,
+        films are saved under IDs starting from save_base_id
+        """
+        db.connect(self.args.dsn)
+        if db.query_value('select count(*) from mdb.movie where id < %s', [save_base_id]) > 0:
+            raise Exception('Database %s contains real films, save benchmark requires '
+                            'a throwaway database' % self.args.dsn)
+        print('Save of %s films' % self.args.films)
+        films = [self.get_film(id) for id in self.get_film_ids()]
+        rows = sum(self.get_rows_count(film) for film in films)
+
+        def save():
+            for number, film in enumerate(films):
+                film.id = save_base_id + number
+                film.save()
+
+        def write():
+            writer = FilmWriter(size=len(films), interval=float('inf'))
+            for number, film in enumerate(films):
+                film.id = save_base_id + len(films) + number
+                writer.add(film)
+            writer.flush()
+
+        # Первые проходы вставляют строки, последующие обновляют уже существующие
+        for name, function in (('Film.save insert', save), ('FilmWriter insert', write)):
+            self.report(name, self.measure(function, 1), rows, 'rows')
+        repeat = max(self.args.repeat // 5, 1)
+        for name, function in (('Film.save update', save), ('FilmWriter update', write)):
+            self.report(name, self.measure(function, repeat), rows, 'rows')
+
+    def run(self):
+        if self.args.only in (None, 'parse'):
+            self.benchmark_parse()
+        if self.args.only in (None, 'crawl'):
+            self.benchmark_crawl()
+        if self.args.only in (None, 'save'):
+            if self.args.dsn is None:
+                print('Save benchmark skipped, set --dsn or BENCH_DSN')
+            else:
+                self.benchmark_save()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(message)s', level=logging.WARNING, stream=sys.stdout)
+    # Модули mdb пишут в лог каждый шаг разбора, это не должно влиять на замер
+    logging.disable(logging.WARNING)
+    app = App()
+    app.run()
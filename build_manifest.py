@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+
+import os
+import re
+import sys
+import sqlite3
+import hashlib
+import logging
+import argparse
+from datetime import date
+
+import config
+from mdb.db import Database
+from mdb.cache import get_cache
+
+db = Database.Instance()
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+base = 'https://www.kinopoisk.ru'
+
+roles = ['actor', 'design', 'writer', 'director', 'editor', 'voice', 'producer', 'operator',
+         'producer_ussr', 'voice_director', 'translator', 'composer']
+
+
+class App():
+    """
+    Fills the cache manifest for pages cached before it was introduced.
+    Cache directory is scanned once, then URLs of known films, persons and
+    listing pages are matched against the found hashes. Sizes of pages in
+    compressed formats are recorded as stored, i.e. compressed.
+    """
+
+    def __init__(self):
+        parser = argparse.ArgumentParser(description='Cache manifest builder')
+        parser.add_argument('--from-id', required=False, default=1, type=int)
+        parser.add_argument('--to-id', required=False, default=None, type=int,
+                            help='Check all film IDs up to this one instead of films '
+                                 'from mdb.movie')
+        parser.add_argument('--no-persons', required=False, default=False, action='store_true')
+        self.args = parser.parse_args()
+        self.cache = get_cache()
+        self.manifest = self.cache.manifest
+        db.connect(config.dsn)
+
+    def scan(self, path):
+        for entry in os.scandir(path):
+            if entry.is_dir(follow_symlinks=False):
+                for item in self.scan(entry.path):
+                    yield item
+            else:
+                m = re.match('^([0-9a-f]{32})(\\.gz|\\.zst)?$', entry.name)
+                if m is not None:
+                    stat = entry.stat()
+                    yield m.group(1), stat.st_size, stat.st_mtime
+
+    def get_hashes(self):
+        """
+        Returns {hash: (size, mtime)} of all pages in the cache
+        """
+        hashes = dict()
+        for hash, size, mtime in self.scan(self.cache.path):
+            if size > 0:
+                hashes[hash] = (size, mtime)
+        index = os.path.join(self.cache.path, 'pack', 'index.sqlite')
+        if os.path.exists(index):
+            mtimes = dict()
+            for hash, pack, length in sqlite3.connect(index).execute(
+                    'select hash, pack, length from entry'):
+                if pack not in mtimes:
+                    mtimes[pack] = os.path.getmtime(os.path.join(self.cache.path, 'pack', pack))
+                hashes[hash] = (length, mtimes[pack])
+        logger.info('Found %s pages in cache' % len(hashes))
+        return hashes
+
+    def get_film_ids(self):
+        if self.args.to_id is not None:
+            return range(self.args.from_id, self.args.to_id + 1)
+        return (row[0] for row in db.query_iter('select id from mdb.movie where id >= %s '
+                                                'order by id', [self.args.from_id]))
+
+    def get_film_urls(self, id):
+        url = '%s/film/%s/' % (base, id,)
+        yield url
+        if not self.cache.is_in_cache(url):
+            return
+        ids = [id]
+        # Страницы премьер и сборов адресуются полным ID, его берём из главной страницы
+        m = re.search('/film/([^/]+)/subscribe/', self.cache.get_file(url) or '')
+        if m is not None and m.group(1) != str(id):
+            ids.append(m.group(1))
+        for full_id in ids:
+            yield '%s/film/%s/dates/' % (base, full_id,)
+            yield '%s/film/%s/box/' % (base, full_id,)
+        yield '%s/film/%s/cast/' % (base, id,)
+        yield 'http://www.kinopoisk.ru/film/%s/cast/' % id
+        for role in roles:
+            yield '%s/film/%s/cast/who_is/%s/' % (base, id, role,)
+            yield '%s/film/%s/cast/who_is/%s/:10000' % (base, id, role,)
+
+    def get_person_urls(self):
+        for row in db.query_iter('select id from mdb.person order by id'):
+            yield '%s/name/%s/' % (base, row[0],)
+
+    def get_listing_urls(self, hashes):
+        for year in range(1890, date.today().year + 2):
+            for mask in ('%s/lists/navigator/%s/?page=%s',
+                         '%s/lists/ord/name/m_act[year]/%s/m_act[all]/ok/page/%s/'):
+                page, missed = 1, 0
+                # Страницы одного года загружаются подряд, поэтому
+                # перебор останавливается после нескольких пропусков
+                while missed < 10:
+                    url = mask % (base, year, page,)
+                    missed = 0 if self.get_hash(url) in hashes else missed + 1
+                    yield url
+                    page += 1
+
+    def get_hash(self, url):
+        return hashlib.md5(url.encode('utf-8')).hexdigest()
+
+    def get_urls(self, hashes):
+        for id in self.get_film_ids():
+            for url in self.get_film_urls(id):
+                yield url
+        if not self.args.no_persons:
+            for url in self.get_person_urls():
+                yield url
+        for url in self.get_listing_urls(hashes):
+            yield url
+
+    def run(self):
+        hashes = self.get_hashes()
+        entries = list()
+        found = 0
+        for url in self.get_urls(hashes):
+            hash = self.get_hash(url)
+            if hash not in hashes:
+                continue
+            size, mtime = hashes.pop(hash)
+            entries.append((url, size, mtime))
+            if len(entries) == 10000:
+                self.manifest.add_many(entries)
+                found += len(entries)
+                entries = list()
+                logger.info('%s pages recorded' % found)
+        self.manifest.add_many(entries)
+        found += len(entries)
+        logger.info('Done, %s pages recorded, %s pages of unknown URL' % (found, len(hashes),))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                        level=logging.INFO, stream=sys.stdout)
+    app = App()
+    app.run()
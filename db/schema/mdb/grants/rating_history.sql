@@ -0,0 +1,3 @@
+/* Загрузчик --rating-history работает под ролью mdb, как и остальные загрузчики */
+grant select, insert on mdb.rating_history to mdb;
+grant select, usage on sequence mdb.rating_history_id_seq to mdb;
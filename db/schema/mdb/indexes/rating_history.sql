@@ -0,0 +1,2 @@
+/* Нужен загрузчику --rating-history: on conflict (movie_id, day) пропускает уже загруженные точки */
+create unique index if not exists rating_history_movie_id_day_idx on mdb.rating_history (movie_id, day);
@@ -0,0 +1,15 @@
+create table mdb.host_stat
+(
+    hostname        text primary key,
+    update_time     timestamptz(0) not null default now(),
+    requests_per_sec numeric,
+    cache_hit_ratio numeric,
+    parse_ms_per_film numeric,
+    db_ms_per_film  numeric,
+    films_per_sec   numeric,
+    captcha         integer
+);
+
+grant select, insert, update on mdb.host_stat to mdb;
+
+comment on table mdb.host_stat is 'Показатели производительности парсера по хостам за последний интервал --stat-interval';
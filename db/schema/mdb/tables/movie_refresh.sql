@@ -0,0 +1,9 @@
+create table mdb.movie_refresh
+(
+    movie_id        integer primary key,
+    refresh_time    timestamptz(0) not null default now()
+);
+
+grant select, insert, update, delete on mdb.movie_refresh to mdb;
+
+comment on table mdb.movie_refresh is 'Время последнего обновления фильма планировщиком --refresh --budget';
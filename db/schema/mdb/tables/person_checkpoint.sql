@@ -0,0 +1,12 @@
+create table mdb.person_checkpoint
+(
+    hostname        text primary key,
+    from_id         integer not null,
+    to_id           integer,
+    last_id         integer not null,
+    update_time     timestamptz(0) not null default now()
+);
+
+grant select, insert, update, delete on mdb.person_checkpoint to mdb;
+
+comment on table mdb.person_checkpoint is 'Последняя сохранённая персона в режиме --persons, перезапуск с тем же диапазоном продолжается с неё';
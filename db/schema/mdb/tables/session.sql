@@ -0,0 +1,12 @@
+create table mdb.session
+(
+    name            text primary key,
+    version         integer not null default 1,
+    user_agent      text,
+    cookies         jsonb not null,
+    update_time     timestamptz(0) not null default now()
+);
+
+grant select, insert, update on mdb.session to mdb;
+
+comment on table mdb.session is 'Cookies и User-Agent парсера, общие для всех хостов, чтобы решённая капча снимала блокировку со всех процессов';
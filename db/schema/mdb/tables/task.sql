@@ -0,0 +1,16 @@
+create table mdb.task
+(
+    id              serial primary key,
+    year            integer not null,
+    page            integer not null,
+    leased_by       text,
+    lease_until     timestamptz(0),
+    attempts        integer not null default 0,
+    done_time       timestamptz(0),
+    unique (year, page)
+);
+
+grant select, insert, update on mdb.task to mdb;
+grant select, usage on sequence mdb.task_id_seq to mdb;
+
+comment on table mdb.task is 'Очередь страниц списков фильмов для параллельного парсинга';
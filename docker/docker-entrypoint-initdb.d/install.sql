@@ -83,6 +83,11 @@ create table mdb.rating_history
 
 comment on table mdb.rating_history is 'Динамика изменения рейтинга фильма';
 
+create unique index on mdb.rating_history (movie_id, day);
+
+grant select, insert on mdb.rating_history to mdb;
+grant select, usage on sequence mdb.rating_history_id_seq to mdb;
+
 
 create table mdb.premiere_date
 (
@@ -226,6 +231,75 @@ grant select, insert on mdb.error to mdb;
 
 comment on table mdb.error is 'Журнал ошибок';
 
+create table mdb.task
+(
+    id              serial primary key,
+    year            integer not null,
+    page            integer not null,
+    leased_by       text,
+    lease_until     timestamptz(0),
+    attempts        integer not null default 0,
+    done_time       timestamptz(0),
+    unique (year, page)
+);
+
+grant select, insert, update on mdb.task to mdb;
+grant select, usage on sequence mdb.task_id_seq to mdb;
+
+comment on table mdb.task is 'Очередь страниц списков фильмов для параллельного парсинга';
+
+create table mdb.host_stat
+(
+    hostname        text primary key,
+    update_time     timestamptz(0) not null default now(),
+    requests_per_sec numeric,
+    cache_hit_ratio numeric,
+    parse_ms_per_film numeric,
+    db_ms_per_film  numeric,
+    films_per_sec   numeric,
+    captcha         integer
+);
+
+grant select, insert, update on mdb.host_stat to mdb;
+
+comment on table mdb.host_stat is 'Показатели производительности парсера по хостам за последний интервал --stat-interval';
+
+create table mdb.session
+(
+    name            text primary key,
+    version         integer not null default 1,
+    user_agent      text,
+    cookies         jsonb not null,
+    update_time     timestamptz(0) not null default now()
+);
+
+grant select, insert, update on mdb.session to mdb;
+
+comment on table mdb.session is 'Cookies и User-Agent парсера, общие для всех хостов, чтобы решённая капча снимала блокировку со всех процессов';
+
+create table mdb.person_checkpoint
+(
+    hostname        text primary key,
+    from_id         integer not null,
+    to_id           integer,
+    last_id         integer not null,
+    update_time     timestamptz(0) not null default now()
+);
+
+grant select, insert, update, delete on mdb.person_checkpoint to mdb;
+
+comment on table mdb.person_checkpoint is 'Последняя сохранённая персона в режиме --persons, перезапуск с тем же диапазоном продолжается с неё';
+
+create table mdb.movie_refresh
+(
+    movie_id        integer primary key,
+    refresh_time    timestamptz(0) not null default now()
+);
+
+grant select, insert, update, delete on mdb.movie_refresh to mdb;
+
+comment on table mdb.movie_refresh is 'Время последнего обновления фильма планировщиком --refresh --budget';
+
 /* Некоторые constraint'ы и индексы лучше создавать после загрузки данных */
 
 alter table mdb.movie add constraint movie_pkey primary key (id);
@@ -0,0 +1,289 @@
+# -*- encoding: utf-8 -*-
+
+import os
+import sys
+import gzip
+import sqlite3
+import hashlib
+import logging
+import threading
+
+from socket import gethostname
+
+from parselab.cache import FileCache
+
+from mdb.manifest import get_manifest, get_content_hash
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class GzipCodec(object):
+
+    extension = '.gz'
+
+    def compress(self, data):
+        return gzip.compress(data, 6)
+
+    def decompress(self, data):
+        return gzip.decompress(data)
+
+
+class ZstdCodec(object):
+
+    extension = '.zst'
+
+    def __init__(self):
+        if zstandard is None:
+            raise Exception('zstandard module is required for zstd cache format')
+
+    def compress(self, data):
+        return zstandard.ZstdCompressor(level=10).compress(data)
+
+    def decompress(self, data):
+        return zstandard.ZstdDecompressor().decompress(data)
+
+
+codecs = {'gzip': GzipCodec, 'zstd': ZstdCodec}
+
+
+class PlainFileCache(FileCache):
+    """
+    FileCache which records written pages in the cache manifest
+    """
+
+    def __init__(self, namespace, path):
+        FileCache.__init__(self, namespace, path)
+        self.manifest = get_manifest(self.path)
+
+    def write_to_cache(self, url, data, binary=False):
+        FileCache.write_to_cache(self, url, data, binary)
+        self.manifest.add(url, self.get_file_size(url), content_hash=get_content_hash(data))
+
+    def remove_from_cache(self, url):
+        FileCache.remove_from_cache(self, url)
+        self.manifest.remove(url)
+
+
+class CompressedFileCache(FileCache):
+    """
+    Page cache which keeps every page compressed in its own file, files are
+    sharded by two levels of the hash prefix: ab/cd/abcd...gz. Pages stored
+    earlier by FileCache, in its sharded or flat layout, are still read,
+    so the cache can be migrated gradually.
+    """
+
+    def __init__(self, namespace, path, codec='gzip'):
+        if path:
+            self.path = os.path.join(path, namespace)
+        else:
+            self.path = os.path.join(os.path.dirname(sys.path[0]), 'cache')
+        self.codec = codecs[codec]()
+        self.manifest = get_manifest(self.path)
+        logger.info('Cache initialization, path = %s, codec = %s' % (self.path, codec,))
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def get_hash(self, url):
+        return hashlib.md5(url.encode('utf-8')).hexdigest()
+
+    def get_entry_filename(self, hash):
+        return os.path.join(self.path, hash[0:2], hash[2:4], hash + self.codec.extension)
+
+    def get_cached_filename(self, url):
+        return self.get_entry_filename(self.get_hash(url))
+
+    def get_legacy_filename(self, url):
+        """
+        Returns name of the file written by FileCache, if there is one
+        """
+        for filename in (FileCache.get_cached_filename(self, url),
+                         self.get_cached_filename_compat(url)):
+            if os.path.exists(filename) and os.path.getsize(filename) > 0:
+                return filename
+        return None
+
+    def has_entry(self, hash):
+        return os.path.exists(self.get_entry_filename(hash))
+
+    def read_entry(self, hash):
+        with open(self.get_entry_filename(hash), 'rb') as f:
+            return self.codec.decompress(f.read())
+
+    def write_entry(self, hash, data):
+        filename = self.get_entry_filename(hash)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        # Запись через временный файл, чтобы параллельные процессы
+        # никогда не увидели недописанную страницу
+        temp_filename = '%s.%s.tmp' % (filename, os.getpid())
+        with open(temp_filename, 'wb') as f:
+            f.write(self.codec.compress(data))
+        os.rename(temp_filename, filename)
+
+    def get_file_size(self, url):
+        return len(self.get_file(url, binary=True))
+
+    def is_in_cache(self, url):
+        return self.has_entry(self.get_hash(url)) or self.get_legacy_filename(url) is not None
+
+    def get_error_filename(self, url):
+        hash = self.get_hash(url)
+        return os.path.join(self.path, hash[0:2], hash[2:4], hash + '.error')
+
+    def is_in_cache_error(self, url):
+        return os.path.exists(self.get_error_filename(url))
+
+    def save_error_in_cache(self, url, error='ERROR'):
+        filename = self.get_error_filename(url)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'wt') as f:
+            f.write(error)
+
+    def get_file(self, url, binary=False):
+        if self.is_in_cache_error(url):
+            return None
+
+        hash = self.get_hash(url)
+        if self.has_entry(hash):
+            data = self.read_entry(hash)
+        else:
+            with open(self.get_legacy_filename(url), 'rb') as f:
+                data = f.read()
+        return data if binary else data.decode('utf-8')
+
+    def write_to_cache(self, url, data, binary=False):
+        if binary:
+            if hasattr(data, 'iter_content'):
+                data = b''.join(data.iter_content(chunk_size=1024))
+        else:
+            data = data.encode('utf-8')
+        self.write_entry(self.get_hash(url), data)
+        self.manifest.add(url, len(data), content_hash=get_content_hash(data))
+        logger.info('Page %s was written into cache' % url)
+
+    def remove_from_cache(self, url):
+        # Страница может лежать как в новом формате, так и в файле FileCache
+        for filename in (self.get_cached_filename(url), self.get_legacy_filename(url)):
+            if filename is not None and os.path.exists(filename):
+                os.remove(filename)
+        self.manifest.remove(url)
+        logger.warning('Page %s has been removed from cache' % url)
+
+
+class PackFileCache(CompressedFileCache):
+    """
+    Page cache which appends compressed pages to large pack files instead of
+    creating a file per page. Offsets of pages are kept in an SQLite index
+    next to the packs. Every process writes its own packs, so appends need
+    no locking between processes.
+    """
+
+    def __init__(self, namespace, path, codec='gzip', pack_size=1024 ** 3):
+        CompressedFileCache.__init__(self, namespace, path, codec)
+        self.pack_size = pack_size
+        self.lock = threading.RLock()
+        self.pid = None
+        os.makedirs(os.path.join(self.path, 'pack'), exist_ok=True)
+
+    def connect(self):
+        """
+        Opens the index, also after fork, because neither SQLite connection
+        nor the current pack file may be shared with the parent process
+        """
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.index = sqlite3.connect(os.path.join(self.path, 'pack', 'index.sqlite'),
+                                     timeout=60, check_same_thread=False)
+        self.index.execute('create table if not exists entry (hash text primary key, '
+                           'pack text not null, offset integer not null, '
+                           'length integer not null)')
+        self.index.commit()
+        self.pack = None
+        self.pack_number = 0
+
+    def get_pack(self, length):
+        if self.pack is not None:
+            self.pack.seek(0, os.SEEK_END)
+        if self.pack is None or self.pack.tell() + length > self.pack_size:
+            if self.pack is not None:
+                self.pack.close()
+            self.pack_number += 1
+            self.pack_name = '%s-%s-%04d.pack' % (gethostname(), self.pid, self.pack_number)
+            self.pack = open(os.path.join(self.path, 'pack', self.pack_name), 'ab')
+            self.pack.seek(0, os.SEEK_END)
+        return self.pack
+
+    def find_entry(self, hash):
+        with self.lock:
+            self.connect()
+            return self.index.execute('select pack, offset, length from entry where hash = ?',
+                                      [hash]).fetchone()
+
+    def has_entry(self, hash):
+        return self.find_entry(hash) is not None
+
+    def read_entry(self, hash):
+        pack, offset, length = self.find_entry(hash)
+        with open(os.path.join(self.path, 'pack', pack), 'rb') as f:
+            f.seek(offset)
+            return self.codec.decompress(f.read(length))
+
+    def write_entry(self, hash, data):
+        data = self.codec.compress(data)
+        with self.lock:
+            self.connect()
+            pack = self.get_pack(len(data))
+            offset = pack.tell()
+            pack.write(data)
+            pack.flush()
+            self.index.execute('insert or replace into entry (hash, pack, offset, length) '
+                               'values (?, ?, ?, ?)', [hash, self.pack_name, offset, len(data)])
+            self.index.commit()
+
+    def remove_from_cache(self, url):
+        with self.lock:
+            self.connect()
+            self.index.execute('delete from entry where hash = ?', [self.get_hash(url)])
+            self.index.commit()
+        # Страница может лежать и в файле FileCache, который читается наравне с pack
+        filename = self.get_legacy_filename(url)
+        if filename is not None:
+            os.remove(filename)
+        self.manifest.remove(url)
+        logger.warning('Page %s has been removed from cache' % url)
+
+
+# Все парсеры процесса используют общий экземпляр кэша, иначе несколько
+# экземпляров PackFileCache дописывали бы один и тот же pack-файл
+caches = dict()
+caches_lock = threading.Lock()
+
+
+def create_cache(format, path):
+    if format == 'plain':
+        return PlainFileCache('kinopoisk', path)
+    elif format == 'pack':
+        return PackFileCache('kinopoisk', path)
+    elif format == 'pack-zstd':
+        return PackFileCache('kinopoisk', path, codec='zstd')
+    return CompressedFileCache('kinopoisk', path, codec=format)
+
+
+def get_cache(format=None):
+    """
+    Returns page cache of the format set by CACHE_FORMAT environment variable:
+    plain (default), gzip, zstd, pack or pack-zstd, one instance per format
+    and path in the process
+    """
+    format = format or os.environ.get('CACHE_FORMAT', 'plain')
+    path = os.environ.get('CACHE_PATH')
+    with caches_lock:
+        if (format, path) not in caches:
+            caches[(format, path)] = create_cache(format, path)
+        return caches[(format, path)]
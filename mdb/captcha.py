@@ -1,54 +1,179 @@
 import requests
-import config
 import base64
 import logging
+import threading
 import time
 
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
+from lxml.etree import XPath
+from lxml.html import fromstring
+
+from mdb.singleton import Singleton
+from mdb.metrics import Metrics
+
+metrics = Metrics.Instance()
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
+find_captcha_image = XPath('//div[@class="captcha__image"]//img')
+find_captcha_key = XPath('//input[@class="form__key"]')
+find_captcha_retpath = XPath('//input[@class="form__retpath"]')
+
+
+class CaptchaError(Exception):
+    pass
+
+
 class CaptchaSolver():
+    """
+    Client of anti-captcha API. Task result is polled with growing
+    intervals, starting from `first_delay` up to `max_delay` seconds,
+    until `timeout` seconds have passed since the task was created.
+    """
 
-    def __init__(self, filename):
-        with open(filename, 'rb') as f:
-            self.data = base64.b64encode(f.read()).decode('utf-8')
+    first_delay = 3
+    max_delay = 10
+    factor = 1.5
+    timeout = 180
 
-    def CreateTask(self):
-        data = {'clientKey': config.anticaptcha['key'], 'languagePool': 'rn',
-                'task': {'type': 'ImageToTextTask', 'body': self.data}}
+    def __init__(self, url, key):
+        self.url = url
+        self.key = key
+        self.session = requests.session()
 
-        r = requests.post('%s/createTask' % config.anticaptcha['url'], json=data)
+    def request(self, method, data):
+        data = dict(data, clientKey=self.key)
+        r = self.session.post('%s/%s' % (self.url, method), json=data)
         if r.status_code != 200:
-            raise Exception('Error in CreateTask(), status_code = %s', r.status_code)
-
+            raise CaptchaError('Error in %s(), status_code = %s' % (method, r.status_code,))
         result = r.json()
         logger.info(result)
+        return result
 
+    def create_task(self, image):
+        task = {'type': 'ImageToTextTask', 'body': base64.b64encode(image).decode('utf-8')}
+        result = self.request('createTask', {'languagePool': 'rn', 'task': task})
         if result['errorId'] != 0:
-            return None
+            raise CaptchaError('Task was not created: %s' % result.get('errorDescription'))
         return result['taskId']
 
-    def GetTaskResult_(self, task_id):
-        data = {'clientKey': config.anticaptcha['key'], 'taskId': task_id}
-        r = requests.post('%s/getTaskResult' % config.anticaptcha['url'], json=data)
-        data = r.json()
-        logger.info(data)
-        return data
+    def get_task_result(self, task_id):
+        deadline = time.time() + self.timeout
+        delay = self.first_delay
+        while True:
+            time.sleep(min(delay, max(deadline - time.time(), 0)))
+            result = self.request('getTaskResult', {'taskId': task_id})
+            if result.get('status') == 'ready':
+                return result['solution']['text']
+            if result.get('errorId', 0) != 0 or result.get('status') != 'processing':
+                raise CaptchaError('Task %s failed: %s' % (task_id, result,))
+            if time.time() >= deadline:
+                raise CaptchaError('Task %s was not solved in %s s' % (task_id, self.timeout,))
+            delay = min(delay * self.factor, self.max_delay)
 
-    def GetTaskResult(self, task_id):
+    def solve(self, image):
+        return self.get_task_result(self.create_task(image))
 
-        solution = None
 
-        while True:
-            data = self.GetTaskResult_(task_id)
+@Singleton
+class CaptchaService(object):
+    """
+    Solves captcha in background threads. A thread which got a captcha page
+    waits for the future returned by solve() while other threads continue
+    crawling. Pages with the same captcha (the same form key) received while
+    it is being solved share the pending future, so a captcha is submitted
+    once. Different captchas are solved concurrently, up to `workers` at
+    once, even when the workers share one session. Until configure() is
+    called with anti-captcha API settings every captcha fails.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = dict()
+        self.solver = None
+        self.workers = 4
+        self.executor = None
 
-            if data['status'] == 'ready':
-                solution = data['solution']['text']
-                break
-            elif data['status'] == 'processing':
-                time.sleep(10)
+    def configure(self, url, key, workers=4):
+        # Один клиент на все задачи, чтобы соединение с API не открывалось заново
+        self.solver = CaptchaSolver(url, key)
+        self.workers = workers
+
+    def get_executor(self):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers,
+                                               thread_name_prefix='captcha')
+        return self.executor
+
+    def get_pending_key(self, session, page_text):
+        """
+        Returns key of the captcha on the page, pages which can not be parsed
+        are grouped by session
+        """
+        try:
+            key = find_captcha_key(fromstring(page_text))
+        except Exception:
+            key = []
+        if len(key) > 0 and key[0].get('value'):
+            return key[0].get('value')
+        return id(session)
+
+    def solve(self, session, url, page_text):
+        """
+        Returns future which is resolved when captcha from the page received
+        for the url is submitted through the session
+        """
+        key = self.get_pending_key(session, page_text)
+        with self.lock:
+            future = self.pending.get(key)
+            if future is None:
+                future = self.get_executor().submit(self.run, session, url, page_text)
+                self.pending[key] = future
+                future.add_done_callback(lambda f: self.release(key, f))
             else:
-                logger.error(data)
-                break
+                metrics.inc('captcha_total', result='shared')
+            return future
+
+    def release(self, key, future):
+        with self.lock:
+            if self.pending.get(key) is future:
+                del self.pending[key]
+
+    def run(self, session, url, page_text):
+        result = 'failed'
+        try:
+            # Капча могла быть уже решена другим процессом, тогда достаточно его cookies
+            if hasattr(session, 'refresh') and session.refresh(force=True):
+                logger.info('Session was updated by another worker, captcha is skipped')
+                result = 'reused'
+                return
+            with metrics.timer('captcha_seconds'):
+                self.submit(session, url, page_text)
+            result = 'solved'
+        finally:
+            metrics.inc('captcha_total', result=result)
 
-        return solution
\ No newline at end of file
+    def submit(self, session, url, page_text):
+        if self.solver is None:
+            raise CaptchaError('Anti-captcha API is not configured')
+        html = fromstring(page_text)
+        captcha_url = find_captcha_image(html)[0].get('src')
+        captcha_key = find_captcha_key(html)[0].get('value')
+        retpath = find_captcha_retpath(html)[0].get('value')
+
+        logger.info('Captcha URL = %s, key = %s' % (captcha_url, captcha_key))
+
+        r = session.get(captcha_url)
+        if r.status_code != 200:
+            raise CaptchaError('Could not download captcha image')
+        solution = self.solver.solve(r.content)
+
+        params = {'key': captcha_key, 'retpath': retpath, 'rep': solution}
+        # /checkcaptcha example:
+        # https://www.kinopoisk.ru/checkcaptcha?key=<key>&retpath=<retpath>&rep=%D0%BB%D1%8E%D0%BD%D0%B3%D1%81%D1%82%D0%B0%D0%B4
+        r = session.get(urljoin(url, '/checkcaptcha'), params=params)
+        if r.status_code != 200:
+            raise CaptchaError('Captcha was not accepted, status_code = %s' % r.status_code)
+        logger.info('CAPTCHA SOLVED!!!')
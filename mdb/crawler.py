@@ -0,0 +1,101 @@
+# -*- encoding: utf-8 -*-
+
+import asyncio
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class AsyncCrawler(object):
+    """
+    Concurrent crawl engine: listing pages are walked in one thread, up to
+    `concurrency` films are fetched and parsed simultaneously and parsed films
+    are saved one by one in a separate thread, so the database connection is
+    never used by two films at once. Stages are connected with bounded queues.
+    """
+
+    def __init__(self, app, concurrency, queue_size=None):
+        self.app = app
+        self.concurrency = concurrency
+        self.queue_size = queue_size or concurrency * 2
+
+    def run(self, films):
+        """
+        Processes films yielded by `films` iterator of (id, title, href)
+        """
+        asyncio.run(self.crawl(films))
+
+    async def crawl(self, films):
+        self.loop = asyncio.get_running_loop()
+        self.films = asyncio.Queue(self.queue_size)
+        self.parsed = asyncio.Queue(self.queue_size)
+        self.stopped = threading.Event()
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as self.fetch_executor, \
+                ThreadPoolExecutor(max_workers=1) as self.save_executor:
+            saver = asyncio.ensure_future(self.save_films())
+            fetchers = [asyncio.ensure_future(self.fetch_films())
+                        for i in range(self.concurrency)]
+            try:
+                await self.loop.run_in_executor(None, self.discover, films)
+            except BaseException:
+                self.stopped.set()
+                for task in fetchers + [saver]:
+                    task.cancel()
+                raise
+            for i in range(self.concurrency):
+                await self.films.put(None)
+            await asyncio.gather(*fetchers)
+            await self.parsed.put(None)
+            await saver
+
+    def call(self, function, *args):
+        """
+        Runs the function in the save thread and returns its result. Used by
+        the films iterator, which runs in the discover thread, to touch the
+        database without interfering with a film being saved.
+        """
+        return self.save_executor.submit(function, *args).result()
+
+    def discover(self, films):
+        """
+        Walks listing pages and feeds film IDs to the fetch queue,
+        blocks while the queue is full
+        """
+        for id, title, href in films:
+            if self.stopped.is_set():
+                return
+            logger.info('%s | %s | %s' % (id, title, href,))
+            asyncio.run_coroutine_threadsafe(self.films.put(id), self.loop).result()
+
+    async def fetch_films(self):
+        while True:
+            id = await self.films.get()
+            if id is None:
+                return
+            try:
+                film = await self.loop.run_in_executor(self.fetch_executor,
+                                                       self.app.get_film, id)
+            except Exception as e:
+                await self.loop.run_in_executor(self.save_executor, self.app.log_error,
+                                                id, str(e))
+                continue
+            # Фильм, который не нужно сохранять (например, не изменившийся
+            # в режиме --refresh), не передаётся дальше
+            if film is not None:
+                await self.parsed.put(film)
+
+    async def save_films(self):
+        while True:
+            film = await self.parsed.get()
+            if film is None:
+                return
+            try:
+                await self.loop.run_in_executor(self.save_executor, self.app.save_film, film)
+            except Exception as e:
+                await self.loop.run_in_executor(self.save_executor, self.app.log_error,
+                                                film.id, str(e))
@@ -1,10 +1,12 @@
 # -*- coding: utf-8 -*-
 
+import io
 import psycopg2
 import psycopg2.extensions
 import psycopg2.extras
 import logging
 
+from contextlib import contextmanager
 from mdb.singleton import Singleton
 
 logger = logging.getLogger(__name__)
@@ -13,6 +15,28 @@ logger.setLevel(logging.WARNING)
 psycopg2.extensions.register_type(psycopg2.extensions.UNICODE)
 
 
+def copy_escape(value):
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n') \
+                .replace('\r', '\\r')
+
+
+def copy_array_item(value):
+    if isinstance(value, str):
+        return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+    return str(value)
+
+
+def copy_value(value):
+    """
+    Formats value for COPY in text format
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, (list, tuple)):
+        value = '{%s}' % ','.join(copy_array_item(i) for i in value)
+    return copy_escape(str(value))
+
+
 @Singleton
 class Database(object):
 
@@ -38,6 +62,21 @@ class Database(object):
         cursor.close()
         return [row for row in data]
 
+    def query_iter(self, query, params=None, itersize=10000):
+        """
+        Streams rows of a large result set through a server-side cursor
+        instead of fetching them all into memory
+        """
+        self.cursor_number = getattr(self, 'cursor_number', 0) + 1
+        cursor = self.conn.cursor('mdb_cursor_%s' % self.cursor_number, withhold=True)
+        cursor.itersize = itersize
+        try:
+            cursor.execute(query, params)
+            for row in cursor:
+                yield row
+        finally:
+            cursor.close()
+
     def query_value(self, query, params=None):
         result = self.query_dict(query, params)
         if result:
@@ -51,3 +90,43 @@ class Database(object):
         cursor.execute(query, params)
         cursor.close()
         return
+
+    def execute_values(self, query, rows, template=None, page_size=1000):
+        """
+        Executes query with a single VALUES placeholder for all rows at once
+        """
+        if not rows:
+            return
+        logger.info('SQL: %s' % query)
+        cursor = self.conn.cursor()
+        psycopg2.extras.execute_values(cursor, query, rows, template, page_size)
+        cursor.close()
+
+    def copy(self, table, columns, rows):
+        """
+        Loads rows into table with COPY
+        """
+        buffer = io.StringIO()
+        for row in rows:
+            buffer.write('\t'.join(copy_value(value) for value in row))
+            buffer.write('\n')
+        buffer.seek(0)
+        cursor = self.conn.cursor()
+        cursor.copy_expert('copy %s (%s) from stdin' % (table, ', '.join(columns)), buffer)
+        cursor.close()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Runs all statements inside the block in one transaction,
+        commits at exit and rolls back on exception
+        """
+        self.conn.autocommit = False
+        try:
+            yield
+            self.conn.commit()
+        except BaseException:
+            self.conn.rollback()
+            raise
+        finally:
+            self.conn.autocommit = True
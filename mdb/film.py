@@ -1,26 +1,105 @@
 #! -*- encoding: utf-8 -*-
 
-import os
 import re
+import json
+import time
 import logging
 
+from concurrent.futures import ThreadPoolExecutor
+from lxml.etree import XPath
 from lxml.html import fromstring
 from mdb.helpers import unhtml, get_date
 from mdb.db import Database
+from mdb.known import Known
+from mdb.cache import get_cache
+from mdb.metrics import Metrics
+from mdb.parsing import Parser
+from mdb.network import get_network_manager
 
-from parselab.cache import FileCache
-from parselab.network import NetworkManager
-from parselab.parsing import BasicParser
+from parselab.network import PageNotFound
 
 db = Database.Instance()
+known = Known.Instance()
+metrics = Metrics.Instance()
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
-
-class Film(BasicParser):
-
-    def __init__(self, id, buffer):
+# Столбцы строк фильма в дочерних таблицах, кроме movie_id: при сохранении
+# строки сравниваются с сохранёнными по всем этим столбцам
+cast_columns = (('person_id', 'integer'), ('role', 'text'), ('commentary', 'text'))
+dates_columns = (('country_id', 'integer'), ('premiere_date', 'date'),
+                 ('premiere_precision', 'char(1)'), ('viewers', 'integer'),
+                 ('commentary', 'text'))
+boxes_columns = (('category', 'text'), ('item', 'text'), ('value', 'bigint'),
+                 ('currency', 'varchar(100)'))
+
+movie_columns = ('title', 'alternative_title', 'year', 'slogan', 'length', 'genres',
+                 'rating_kinopoisk', 'rating_imdb', 'directors', 'scenario', 'operators',
+                 'composers', 'producers', 'arts', 'editors', 'age_restriction', 'countries',
+                 'rating_critics', 'world_premiere', 'rating_mpaa', 'production_status')
+
+# Условие для on conflict: сохранённый фильм перезаписывается, только если изменился
+movie_changed = '(%s) is distinct from (%s)' % (
+    ', '.join('mdb.movie.%s' % column for column in movie_columns),
+    ', '.join('excluded.%s' % column for column in movie_columns))
+
+rating_changed = '(mdb.movie_rating.rating, mdb.movie_rating.vote_count) ' \
+                 'is distinct from (excluded.rating, excluded.vote_count)'
+
+
+def rows_match(columns, left='t', right='v'):
+    return ' and '.join('%s.%s is not distinct from %s.%s' % (left, name, right, name)
+                        for name, type in columns)
+
+# Выражения XPath и регулярные выражения компилируются один раз при загрузке
+# модуля, а не при каждом вызове, в том числе в циклах по строкам таблиц
+find_subscribe_link = XPath('//div[@class="subscribe"]/div[@class="link"]/a')
+find_title = XPath('//h1[@class="moviename-big"]')
+find_alternative_title = XPath('//span[@itemprop="alternativeHeadline"]')
+find_links = XPath('.//a')
+find_info_rows = XPath('//table[contains(@class, "info")]//tr')
+find_info_type = XPath('.//td[@class="type"]')
+find_info_value = XPath('.//td[2]')
+find_person_name = XPath('.//div[@class="info"]//div[@class="name"]//a')
+find_person_alternative_name = XPath('.//div[@class="info"]//div[@class="name"]'
+                                     '//span[@class="gray"]')
+find_person_commentary = XPath('.//div[@class="info"]//div[@class="role"]')
+find_role_anchors = XPath('//a[@name]')
+find_dub = XPath('//div[contains(@class, "dub")]')
+find_cast_links = XPath('//td[contains(@class, "anchers")]//a[@class="all"]')
+find_rating_kinopoisk = XPath('//span[@class="rating_ball"]')
+find_rating_count = XPath('//span[@class="ratingCount"]')
+find_rating_blocks = XPath('//div[@id="block_rating"]//div')
+find_rating_critics = XPath('//div[contains(@class, "criticsRating")]//div[@class="star"]')
+find_premiere = XPath('.//div[@class="prem_ical"]')
+find_dates_flags = XPath('//table//tr//div[contains(@class, "flag")]')
+find_all_links = XPath('.//a[contains(@class, "all")]')
+find_small = XPath('.//small')
+find_boxes_tables = XPath('//div[@style="width: 274px"]//table')
+find_boxes_group = XPath('.//tr//td')
+find_boxes_titles = XPath('.//td[@colspan="2"]//b')
+find_cells = XPath('.//td')
+find_images = XPath('.//img')
+find_production_status = XPath('//img[@src="https://st.kp.yandex.net/images/'
+                               'status-production.gif"]')
+
+full_id_regexp = re.compile('^/film/([^/]+)/subscribe/$')
+country_id_regexp = re.compile(r'/country-(\d+)/')
+country_id_tail_regexp = re.compile(r'/(\d+)/$')
+person_id_regexp = re.compile(r'/name/(\d+)/$')
+genre_id_regexp = re.compile(r'/navigator/([^/]+)/')
+length_regexp = re.compile(r'(\d+) мин', re.UNICODE)
+year_regexp = re.compile(r'(\d{4})')
+imdb_regexp = re.compile(r'^IMDb: ([\d\.]+) \(([^)]+)\)')
+viewers_regexp = re.compile(r'(.+)чел.', re.UNICODE)
+currency_regexp = re.compile(r'^([^\d]+)')
+non_digits_regexp = re.compile(r'[^\d]', re.UNICODE)
+
+
+class Film(Parser):
+
+    def __init__(self, id, buffer, workers=1, cache=None, net=None):
         self.buffer = buffer
         self.html = fromstring(buffer)
         self.id = id
@@ -44,51 +123,90 @@ class Film(BasicParser):
         self.boxes = list()
         self.rating_mpaa = None
         self.production_status = None
+        self.workers = workers
+        self.executor = None
+        self.prefetched = dict()
+        self.fetch_time = 0
         self.full_id = self.get_full_id()
         logger.info('Full ID = %s' % self.full_id)
 
-        self.cache = FileCache(namespace='kinopoisk', path=os.environ.get('CACHE_PATH'))
-        self.net = NetworkManager()
+        if cache is None:
+            cache = get_cache()
+        if net is None:
+            net = get_network_manager()
+        self.cache = cache
+        self.net = net
 
         self.parse()
 
+    def prefetch(self, urls, **kwargs):
+        """
+        Запускает параллельную загрузку страниц, если у фильма есть пул потоков.
+        Загруженные страницы затем отдаются из get_page() с теми же аргументами
+        """
+        if self.executor is None:
+            return
+        for url in urls:
+            key = (url, kwargs.get('salt'))
+            if key not in self.prefetched:
+                self.prefetched[key] = self.executor.submit(super(Film, self).get_page, url,
+                                                            **kwargs)
+
+    def get_page(self, url, *args, **kwargs):
+        # Время ожидания страниц не входит во время разбора фильма
+        start = time.time()
+        try:
+            future = None
+            if not args:
+                future = self.prefetched.pop((url, kwargs.get('salt')), None)
+            if future is not None:
+                return future.result()
+            return super(Film, self).get_page(url, *args, **kwargs)
+        finally:
+            self.fetch_time += time.time() - start
+
+    def get_optional_page(self, url):
+        """
+        Возвращает None для страниц, которых нет на сайте
+        (или в кэше при разборе без доступа к сети)
+        """
+        try:
+            return self.get_page(url)
+        except PageNotFound:
+            return None
+
     def get_full_id(self):
         """
         Возвращает целый ID, в том виде, к котором его нужно подставлять в ссылки,
         например "brand-time-commercial-2017-1027743"
         """
-        a = self.html.xpath('//div[@class="subscribe"]/div[@class="link"]/a')
+        a = find_subscribe_link(self.html)
         if len(a) == 0:
             raise Exception('Could not get full ID')
-        m = re.search('^/film/([^/]+)/subscribe/$', a[0].get('href'))
+        m = full_id_regexp.search(a[0].get('href'))
         return m.group(1)
 
     def parse_title(self):
-        h1 = self.html.xpath('//h1[@class="moviename-big"]')
+        h1 = find_title(self.html)
         self.title = unhtml(h1[0].text_content())
-        alternative = self.html.xpath('//span[@itemprop="alternativeHeadline"]')
+        alternative = find_alternative_title(self.html)
         if len(alternative) > 0:
             self.alternative_title = alternative[0].text_content()
 
     def extract_country_id_from_url(self, url):
-        m = re.search('/country-(\d+)/', url)
+        m = country_id_regexp.search(url)
         if m is None:
-            m = re.search('/(\d+)/$', url)
+            m = country_id_tail_regexp.search(url)
         if m is None:
             raise Exception('Invalid URL format for country')
         return int(m.group(1))
 
     def extract_person_id_from_url(self, url):
-        m = re.search('/name/(\d+)/$', url)
+        m = person_id_regexp.search(url)
         return int(m.group(1))
 
-    def save_country(self, id, name):
-        exists = db.query_value('select id from mdb.country where id = %s', [id])
-        if exists is None:
-            db.execute('insert into mdb.country(id, name) values (%s, %s)', [id, name])
-
     def parse_countries(self, elem):
-        for a in elem.xpath('.//a'):
+        for a in find_links(elem):
             href = a.get('href')
             name = a.text_content()
             id = self.extract_country_id_from_url(href)
@@ -98,9 +216,9 @@ class Film(BasicParser):
         return unhtml(elem.text_content())
 
     def update_person_array(self, role, elem):
-        for item in elem.xpath('.//a'):
+        for item in find_links(elem):
             href = item.get('href')
-            m = re.search('/name/(\d+)/$', href)
+            m = person_id_regexp.search(href)
             if m is None:
                 continue
             id = int(m.group(1))
@@ -108,79 +226,113 @@ class Film(BasicParser):
             self.persons.append({'id': id, 'name': name, 'role': role})
 
     def parse_length(self, elem):
-        m = re.search(u'(\d+) мин', elem.text_content(), re.UNICODE)
+        m = length_regexp.search(elem.text_content())
         if m is not None:
             return int(m.group(1))
         else:
             return None
 
     def parse_year(self, elem):
-        m = re.search('(\d{4})', elem.text_content().strip())
+        m = year_regexp.search(elem.text_content().strip())
         if m is not None:
             self.year = int(m.group(1))
         else:
             return None
 
-    def save_persons(self):
+    def get_persons_rows(self):
+        persons = dict()
         for person in self.cast:
-            id = db.query_value('select id from mdb.person where id = %s', [person['id']])
-            if id is None:
-                db.execute('insert into mdb.person (id, name, alternative_name) '
-                           'values (%s, %s, %s)', [person['id'], person['name'],
-                                                   person['alternative_name']])
+            persons.setdefault(person['id'], (person['id'], person['name'],
+                                              person['alternative_name']))
+        return list(persons.values())
+
+    def save_persons(self):
+        """
+        Сохраняет персоны, которых ещё нет в базе, возвращает их ID
+        """
+        rows = known.filter_persons(self.get_persons_rows())
+        db.execute_values('insert into mdb.person (id, name, alternative_name) values %s '
+                          'on conflict (id) do nothing', rows)
+        return [row[0] for row in rows]
+
+    def get_cast_rows(self):
+        return [(self.id, person['id'], person['role'], person['commentary'])
+                for person in self.cast]
 
     def save_cast(self):
-        db.execute('delete from mdb.person_in_movie where movie_id = %s', [self.id])
-        for person in self.cast:
-            db.execute('insert into mdb.person_in_movie(movie_id, person_id, role, commentary) '
-                       'values (%s, %s, %s, %s)', [self.id, person['id'], person['role'],
-                                                   person['commentary']])
+        self.sync_rows('mdb.person_in_movie', cast_columns, self.get_cast_rows())
 
-    def save_countries(self):
+    def sync_rows(self, table, columns, rows):
+        """
+        Brings rows of the film in the child table to the parsed rows with one
+        statement: stored rows which were not parsed are deleted, parsed rows
+        which are not stored are inserted, the rest are not touched
+        """
+        names = [name for name, type in columns]
+        match = rows_match(columns)
+        db.execute('with v as (select * from jsonb_to_recordset(%%s::jsonb) as v(%s)), '
+                   'deleted as (delete from %s t where t.movie_id = %%s '
+                   '            and not exists (select 1 from v where %s)) '
+                   'insert into %s (movie_id, %s) select %%s, %s from v '
+                   ' where not exists (select 1 from %s t where t.movie_id = %%s and %s)'
+                   % (', '.join('%s %s' % column for column in columns), table, match,
+                      table, ', '.join(names), ', '.join('v.%s' % name for name in names),
+                      table, match),
+                   [json.dumps([dict(zip(names, row[1:])) for row in rows]),
+                    self.id, self.id, self.id])
+
+    def get_countries_rows(self):
+        countries = dict()
         for country in (self.countries + self.countries_to_save):
-            self.save_country(country['id'], country['name'])
+            countries.setdefault(country['id'], (country['id'], country['name']))
+        return list(countries.values())
+
+    def save_countries(self):
+        """
+        Сохраняет страны, которых ещё нет в справочнике, возвращает их ID
+        """
+        rows = known.filter_countries(self.get_countries_rows())
+        db.execute_values('insert into mdb.country(id, name) values %s on conflict do nothing',
+                          rows)
+        return [row[0] for row in rows]
 
     def get_array_of_id(self, for_list):
         return [int(i['id']) for i in for_list]
 
+    def get_movie_row(self):
+        return (self.id, self.title, self.alternative_title, self.year,
+                self.slogan, self.length, [g['id'] for g in self.genres],
+                self.rating_kinopoisk, self.rating_imdb,
+                self.get_persons_by_role('director'), self.get_persons_by_role('writer'),
+                self.get_persons_by_role('operator'), self.get_persons_by_role('composer'),
+                self.get_persons_by_role('producer'), self.get_persons_by_role('design'),
+                self.get_persons_by_role('editor'), self.age_restriction,
+                self.get_array_of_id(self.countries), self.rating_critics,
+                self.world_premiere, self.rating_mpaa, self.production_status)
+
     def save_movie(self):
-        id = db.query_value('select id from mdb.movie where id = %s', [self.id])
-        if id is None:
-            db.execute('insert into mdb.movie(id, title, alternative_title, year, slogan, '
-                       'length, genres, rating_kinopoisk, rating_imdb, '
-                       'directors, scenario, operators, composers, producers, arts, editors, '
-                       'age_restriction, countries, rating_critics, world_premiere, '
-                       'rating_mpaa, production_status) '
-                       'values (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, '
-                       '%s, %s, %s, %s, %s, %s)',
-                       [self.id, self.title, self.alternative_title, self.year,
-                        self.slogan, self.length, [g['id'] for g in self.genres],
-                        self.rating_kinopoisk, self.rating_imdb,
-                        self.get_persons_by_role('director'), self.get_persons_by_role('writer'),
-                        self.get_persons_by_role('operator'), self.get_persons_by_role('composer'),
-                        self.get_persons_by_role('producer'), self.get_persons_by_role('design'),
-                        self.get_persons_by_role('editor'), self.age_restriction,
-                        self.get_array_of_id(self.countries), self.rating_critics,
-                        self.world_premiere, self.rating_mpaa, self.production_status])
-        else:
-            db.execute('update mdb.movie set title = %s, alternative_title = %s, year = %s, '
-                       'slogan = %s, length = %s, genres = %s, rating_kinopoisk = %s, '
-                       'rating_imdb = %s, directors = %s, scenario = %s, '
-                       'operators = %s, composers = %s, producers = %s, arts = %s, '
-                       'editors = %s, age_restriction = %s, countries = %s, rating_critics = %s, '
-                       'world_premiere = %s, update_date = now(), rating_mpaa = %s, '
-                       'production_status = %s '
-                       'where id = %s',
-                       [self.title, self.alternative_title, self.year, self.slogan,
-                        self.length, [g['id'] for g in self.genres],
-                        self.rating_kinopoisk, self.rating_imdb,
-                        self.get_persons_by_role('director'), self.get_persons_by_role('writer'),
-                        self.get_persons_by_role('operator'), self.get_persons_by_role('composer'),
-                        self.get_persons_by_role('producer'), self.get_persons_by_role('design'),
-                        self.get_persons_by_role('editor'), self.age_restriction,
-                        self.get_array_of_id(self.countries), self.rating_critics,
-                        self.world_premiere, self.rating_mpaa, self.production_status,
-                        self.id])
+        db.execute('insert into mdb.movie(id, title, alternative_title, year, slogan, '
+                   'length, genres, rating_kinopoisk, rating_imdb, '
+                   'directors, scenario, operators, composers, producers, arts, editors, '
+                   'age_restriction, countries, rating_critics, world_premiere, '
+                   'rating_mpaa, production_status) '
+                   'values (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, '
+                   '%s, %s, %s, %s, %s, %s) '
+                   'on conflict (id) do update set title = excluded.title, '
+                   'alternative_title = excluded.alternative_title, year = excluded.year, '
+                   'slogan = excluded.slogan, length = excluded.length, '
+                   'genres = excluded.genres, rating_kinopoisk = excluded.rating_kinopoisk, '
+                   'rating_imdb = excluded.rating_imdb, directors = excluded.directors, '
+                   'scenario = excluded.scenario, operators = excluded.operators, '
+                   'composers = excluded.composers, producers = excluded.producers, '
+                   'arts = excluded.arts, editors = excluded.editors, '
+                   'age_restriction = excluded.age_restriction, countries = excluded.countries, '
+                   'rating_critics = excluded.rating_critics, '
+                   'world_premiere = excluded.world_premiere, update_date = now(), '
+                   'rating_mpaa = excluded.rating_mpaa, '
+                   'production_status = excluded.production_status '
+                   'where ' + movie_changed,
+                   self.get_movie_row())
 
     def extract_people_from_list(self, role, div, html, skip_first_div):
         if skip_first_div is True:
@@ -194,9 +346,9 @@ class Film(BasicParser):
 
             person = dict()
 
-            name = div.xpath('.//div[@class="info"]//div[@class="name"]//a')[0]
-            alternative_name = div.xpath('.//div[@class="info"]//div[@class="name"]//span[@class="gray"]')
-            commentary = div.xpath('.//div[@class="info"]//div[@class="role"]')
+            name = find_person_name(div)[0]
+            alternative_name = find_person_alternative_name(div)
+            commentary = find_person_commentary(div)
 
             person['id'] = self.extract_person_id_from_url(name.get('href'))
             person['name'] = name.text_content()
@@ -214,50 +366,51 @@ class Film(BasicParser):
 
     def extract_people_from_cast_page(self, url, check_pages=False):
         """
-        Извлекает со страницы данные о создателях фильма
+        Извлекает со страницы данные о создателях фильма. Возвращает роль
+        последнего списка, если у него есть продолжение на следующей странице
         """
         logger.info('Extracting people from cast page "%s"' % url)
 
         page = self.get_page(url)
         html = fromstring(page)
         count = len(self.cast)
-        start_list = 0
+        last_role = None
 
-        for anchor in html.xpath('//a'):
+        for anchor in find_role_anchors(html):
             role = anchor.get('name')
-            if role is None:
-                continue
             div = anchor.getnext()
 
             last_role = role
             self.extract_people_from_list(last_role, div, html, True)
 
-        people_extracted = len(self.cast) - count
-
-        if check_pages is True and people_extracted == 100:
-            # Следующие страницы стоит пытаться получить только
-            # в случае, если с текущей мы извлекли 100 записей,
-            # поскольку состав разбивается на страницы по 100 человек
-            #while people_extracted > 0:
-            start_list = 10000
-            logger.info('Trying to get more pages...')
-            count = len(self.cast)
-            page = self.get_page(url, method='POST', salt=str(start_list),
-                                 data={'start_list': start_list})
-            html = fromstring(page)
-            self.extract_people_from_list(last_role,
-                                          html.xpath('//div[contains(@class, "dub")]')[0],
-                                          html, False)
-            people_extracted = len(self.cast) - count
+        # Следующие страницы стоит пытаться получить только
+        # в случае, если с текущей мы извлекли 100 записей,
+        # поскольку состав разбивается на страницы по 100 человек
+        if check_pages is True and len(self.cast) - count == 100:
+            return last_role
+        return None
+
+    def get_continuation_args(self):
+        start_list = 10000
+        return {'method': 'POST', 'salt': str(start_list), 'data': {'start_list': start_list}}
+
+    def extract_people_from_continuation(self, url, role):
+        logger.info('Trying to get more pages...')
+        page = self.get_page(url, **self.get_continuation_args())
+        html = fromstring(page)
+        self.extract_people_from_list(role, find_dub(html)[0], html, False)
+
+    def get_cast_url(self):
+        return 'https://www.kinopoisk.ru/film/%s/cast/' % self.id
 
     def get_cast(self):
-        page = self.get_page('https://www.kinopoisk.ru/film/%s/cast/' % self.id)
+        page = self.get_page(self.get_cast_url())
         html = fromstring(page)
 
         self.cast = list()
         cast_links = list()
 
-        links = html.xpath('//td[contains(@class, "anchers")]//a[@class="all"]')
+        links = find_cast_links(html)
         for link in links:
             if '/who_is/' in link.get('href'):
                 cast_links.append('https://www.kinopoisk.ru%s' % link.get('href'))
@@ -267,29 +420,43 @@ class Film(BasicParser):
             # добавим её вручную. Также проверять, есть ли ещё записи на странице нужно
             # только в том случае, если состав разбит на несколько страниц по группам
             cast_links.append('https://www.kinopoisk.ru/film/%s/cast/who_is/actor/' % self.id)
-            [self.extract_people_from_cast_page(url, check_pages=True) for url in cast_links]
+            self.prefetch(cast_links)
+            continuations = list()
+            for url in cast_links:
+                role = self.extract_people_from_cast_page(url, check_pages=True)
+                if role is not None:
+                    # Продолжение загружается, пока разбираются остальные группы,
+                    # его персоны затем вставляются в состав сразу после своей группы
+                    self.prefetch([url], **self.get_continuation_args())
+                    continuations.append((len(self.cast), url, role))
+            for position, url, role in reversed(continuations):
+                count = len(self.cast)
+                self.extract_people_from_continuation(url, role)
+                people = self.cast[count:]
+                del self.cast[count:]
+                self.cast[position:position] = people
         else:
-            self.extract_people_from_cast_page('https://www.kinopoisk.ru/film/%s/cast/' % self.id)
+            self.extract_people_from_cast_page(self.get_cast_url())
 
     def get_ratings(self):
         kinopoisk = dict()
 
-        kinopoisk_rating = self.html.xpath('//span[@class="rating_ball"]')
-        kinopoisk_count = self.html.xpath('//span[@class="ratingCount"]')
+        kinopoisk_rating = find_rating_kinopoisk(self.html)
+        kinopoisk_count = find_rating_count(self.html)
 
         if kinopoisk_rating is not None and len(kinopoisk_rating) > 0:
             kinopoisk['rating_system'] = 'kinopoisk'
             kinopoisk['rating'] = float(kinopoisk_rating[0].text_content())
-            kinopoisk['vote_count'] = int(re.sub('[^\d]', '', kinopoisk_count[0].text_content().replace('&nbsp;', ''), re.UNICODE))
+            kinopoisk['vote_count'] = int(non_digits_regexp.sub('', kinopoisk_count[0].text_content()))
             self.ratings.append(kinopoisk)
             self.rating_kinopoisk = kinopoisk['rating']
 
         imdb = dict()
 
-        for div in self.html.xpath('//div[@id="block_rating"]//div'):
+        for div in find_rating_blocks(self.html):
             if div.text_content().startswith('IMDb:'):
                 imdb['rating_system'] = 'imdb'
-                m = re.search('^IMDb: ([\d\.]+) \(([^)]+)\)', div.text_content())
+                m = imdb_regexp.search(div.text_content())
                 imdb['rating'] = float(m.group(1))
                 imdb['vote_count'] = int(m.group(2).replace(' ', ''))
 
@@ -298,7 +465,7 @@ class Film(BasicParser):
                 break
 
         critics_rating = dict()
-        critics = self.html.xpath('//div[contains(@class, "criticsRating")]//div[@class="star"]')
+        critics = find_rating_critics(self.html)
 
         if critics is not None and len(critics) > 0:
             critics_rating['rating_system'] = 'critics'
@@ -308,38 +475,43 @@ class Film(BasicParser):
             self.ratings.append(critics_rating)
             self.rating_critics = critics_rating['rating']
 
+    def get_ratings_rows(self):
+        return [(self.id, rating['rating_system'], rating['rating'], rating['vote_count'])
+                for rating in self.ratings]
+
     def save_ratings(self):
-        for rating in self.ratings:
-            id = db.query_value('select id from mdb.movie_rating where movie_id = %s and '
-                                'rating_system = %s', [self.id, rating['rating_system']])
-            if id is None:
-                db.execute('insert into mdb.movie_rating (movie_id, rating_system, rating, '
-                           'vote_count) values (%s, %s, %s, %s)',
-                           [self.id, rating['rating_system'], rating['rating'],
-                            rating['vote_count']])
-            else:
-                db.execute('update mdb.movie_rating set rating = %s, vote_count = %s '
-                           'where movie_id = %s and rating_system = %s',
-                           [rating['rating'], rating['vote_count'], self.id,
-                            rating['rating_system']])
+        db.execute_values('insert into mdb.movie_rating (movie_id, rating_system, rating, '
+                          'vote_count) values %s '
+                          'on conflict (movie_id, rating_system) do update '
+                          'set rating = excluded.rating, vote_count = excluded.vote_count '
+                          'where ' + rating_changed,
+                          self.get_ratings_rows())
 
     def extract_genre_id_from_url(self, url):
-        m = re.search('/navigator/([^\/]+)/', url)
+        m = genre_id_regexp.search(url)
         return m.group(1)
 
     def get_genres(self, second_column):
-        for a in second_column.xpath('.//a'):
+        for a in find_links(second_column):
             if a.get('href').startswith(u'/lists/navigator/'):
                 id = self.extract_genre_id_from_url(a.get('href'))
                 name = a.text_content()
                 self.genres.append({'id': id, 'name': name})
 
-    def save_genres(self):
+    def get_genres_rows(self):
+        genres = dict()
         for genre in self.genres:
-            id = db.query_value('select id from mdb.genre where id = %s', [genre['id']])
-            if id is None:
-                db.execute('insert into mdb.genre(id, name) values (%s, %s)',
-                [genre['id'], genre['name']])
+            genres.setdefault(genre['id'], (genre['id'], genre['name']))
+        return list(genres.values())
+
+    def save_genres(self):
+        """
+        Сохраняет жанры, которых ещё нет в справочнике, возвращает их ID
+        """
+        rows = known.filter_genres(self.get_genres_rows())
+        db.execute_values('insert into mdb.genre(id, name) values %s on conflict do nothing',
+                          rows)
+        return [row[0] for row in rows]
 
     def get_persons_by_role(self, role):
         return [int(i['id']) for i in self.cast if i['role'] == role]
@@ -348,7 +520,7 @@ class Film(BasicParser):
         self.age_restriction = elem.text_content().strip()
 
     def get_premieres(self, elem):
-        div = elem.xpath('.//div[@class="prem_ical"]')
+        div = find_premiere(elem)
         if div is not None and len(div) > 0:
             date = get_date(div[0].get('data-ical-date').strip())
             premiere = {'region': div[0].get('data-ical-type')}
@@ -357,35 +529,38 @@ class Film(BasicParser):
             if premiere['region'] == 'world':
                 self.world_premiere = date['date']
 
+    def get_premieres_rows(self):
+        return [(self.id, premiere['region'], premiere['date'], premiere['precision'])
+                for premiere in self.premieres]
+
     def save_premieres(self):
-        for premiere in self.premieres:
-            id = db.query_value('select id from mdb.premiere_date where movie_id = %s and '
-                                'region = %s', [self.id, premiere['region']])
-            if id is None:
-                db.execute('insert into mdb.premiere_date (movie_id, region, premiere_date, '
-                           'precision) values (%s, %s, %s, %s)',
-                           [self.id, premiere['region'], premiere['date'], premiere['precision']])
+        db.execute_values('insert into mdb.premiere_date (movie_id, region, premiere_date, '
+                          'precision) values %s on conflict (movie_id, region) do nothing',
+                          self.get_premieres_rows())
+
+    def get_dates_url(self):
+        return 'https://www.kinopoisk.ru/film/%s/dates/' % self.full_id
 
     def get_dates(self):
-        page = self.get_page('https://www.kinopoisk.ru/film/%s/dates/' % self.full_id)
+        page = self.get_optional_page(self.get_dates_url())
         if page is None:
             logger.warning('There is no information about dates')
             return
         html = fromstring(page)
-        for div in html.xpath('//table//tr//div[contains(@class, "flag")]'):
+        for div in find_dates_flags(html):
             td_date = div.getparent().getnext()
-            td_country = td_date.getnext().xpath('.//a[contains(@class, "all")]')
-            td_small = td_date.getnext().xpath('.//small')
-            td_count = td_date.getnext().getnext().xpath('.//small')
+            td_country = find_all_links(td_date.getnext())
+            td_small = find_small(td_date.getnext())
+            td_count = find_small(td_date.getnext().getnext())
 
             date = get_date(td_date[0].text_content().strip())
             country = td_country[0].text_content()
             country_id = self.extract_country_id_from_url(td_country[0].get('href'))
             small = td_small[0].text_content().strip()
-            m = re.search(u'(.+)чел.', td_count[0].text_content(), re.UNICODE)
+            m = viewers_regexp.search(td_count[0].text_content())
 
             try:
-                count = re.sub('[^\d]', '', m.group(1))
+                count = non_digits_regexp.sub('', m.group(1))
                 count = int(count)
             except (AttributeError, ValueError):
                 count = None
@@ -395,79 +570,95 @@ class Film(BasicParser):
             self.dates.append({'date': date, 'country_id': country_id,
                                'commentary': small, 'viewers': count})
 
+    def get_dates_rows(self):
+        return [(self.id, date['country_id'], date['date']['date'], date['date']['precision'],
+                 date['viewers'], date['commentary']) for date in self.dates]
+
     def save_dates(self):
-        db.execute('delete from mdb.movie_dates where movie_id = %s', [self.id])
-        for date in self.dates:
-            db.execute('insert into mdb.movie_dates (movie_id, country_id, premiere_date, '
-                       'premiere_precision, viewers, commentary) '
-                       'values (%s, %s, %s, %s, %s, %s)',
-                       [self.id, date['country_id'], date['date']['date'],
-                        date['date']['precision'], date['viewers'], date['commentary']])
+        self.sync_rows('mdb.movie_dates', dates_columns, self.get_dates_rows())
+
+    def get_boxes_url(self):
+        return 'https://www.kinopoisk.ru/film/%s/box/' % self.full_id
 
     def get_boxes(self):
         """
         Информация о кассовых сборах и бюджете
         """
         logger.info('Parsing boxes')
-        page = self.get_page('https://www.kinopoisk.ru/film/%s/box/' % self.full_id)
+        page = self.get_optional_page(self.get_boxes_url())
         if page is None:
             return
         html = fromstring(page)
-        for div in html.xpath('//div[@style="width: 274px"]//table'):
-            group = div.xpath('.//tr//td')[0].text_content()
-            for b in div.xpath('.//td[@colspan="2"]//b'):
+        for div in find_boxes_tables(html):
+            group = find_boxes_group(div)[0].text_content()
+            for b in find_boxes_titles(div):
                 title = b.text_content().replace(':', '')
                 if title == group:
                     continue
-                next_tr = b.getparent().getparent().getnext().xpath('.//td')[0]
-                m = re.search('^([^\d]+)', next_tr.text_content().strip())
+                next_tr = find_cells(b.getparent().getparent().getnext())[0]
+                m = currency_regexp.search(next_tr.text_content().strip())
                 if m is not None:
                     currency = m.group(1).strip()
                 else:
                     currency = None
-                value = re.sub('[^\d]', '', next_tr.text_content().strip(), re.UNICODE)
+                value = non_digits_regexp.sub('', next_tr.text_content().strip())
                 logger.info('"%s" : "%s" (%s)' % (title, value, currency,))
                 if value != '':
                     self.boxes.append({'category': group, 'item': title, 'value': value,
                                        'currency': currency})
 
+    def get_boxes_rows(self):
+        return [(self.id, box['category'], box['item'], box['value'], box['currency'])
+                for box in self.boxes]
+
     def save_boxes(self):
-        db.execute('delete from mdb.movie_boxes where movie_id = %s', [self.id])
-        for box in self.boxes:
-            db.execute('insert into mdb.movie_boxes(movie_id, category, item, value, currency) '
-                       'values (%s, %s, %s, %s, %s)',
-                       [self.id, box['category'], box['item'], box['value'], box['currency']])
+        self.sync_rows('mdb.movie_boxes', boxes_columns, self.get_boxes_rows())
 
     def get_mpaa(self, elem):
         try:
-            self.rating_mpaa = elem.xpath('.//img')[0].get('alt').replace(u'рейтинг ', '')
+            self.rating_mpaa = find_images(elem)[0].get('alt').replace(u'рейтинг ', '')
         except IndexError:
             pass
 
     def get_production_status(self):
-        news = self.html.xpath('//img[@src="https://st.kp.yandex.net/images/status-production.gif"]')
+        news = find_production_status(self.html)
         if len(news) == 0:
             return
 
         self.production_status = news[0].getparent().getnext().getnext().text_content()
 
     def save(self):
-        self.save_persons()
-        self.save_countries()
-        self.save_genres()
-        self.save_movie()
-        self.save_premieres()
-        self.save_cast()
-        self.save_ratings()
-        self.save_dates()
-        self.save_boxes()
+        """
+        Сохраняет фильм целиком в одной транзакции, так что при ошибке
+        в базе не остаётся частично сохранённых фильмов
+        """
+        with metrics.timer('save_seconds', mode='film'):
+            with db.transaction():
+                with metrics.timer('film_save_step_seconds', step='persons'):
+                    persons = self.save_persons()
+                with metrics.timer('film_save_step_seconds', step='dictionaries'):
+                    countries = self.save_countries()
+                    genres = self.save_genres()
+                for step, save in (('movie', self.save_movie),
+                                   ('premieres', self.save_premieres),
+                                   ('cast', self.save_cast),
+                                   ('ratings', self.save_ratings),
+                                   ('dates', self.save_dates),
+                                   ('boxes', self.save_boxes)):
+                    with metrics.timer('film_save_step_seconds', step=step):
+                        save()
+        metrics.inc('films_saved_total', mode='film')
+        known.add_movies([self.id])
+        known.persons.update(persons)
+        known.countries.update(countries)
+        known.genres.update(genres)
 
     def parse_info(self):
-        for line in self.html.xpath('//table[contains(@class, "info")]//tr'):
-            info_type = line.xpath('.//td[@class="type"]')[0]
+        for line in find_info_rows(self.html):
+            info_type = find_info_type(line)[0]
             info_type_str = info_type.text_content()
 
-            second_column = line.xpath('.//td[2]')[0]
+            second_column = find_info_value(line)[0]
 
             if info_type_str == u'страна':
                 self.parse_countries(second_column)
@@ -491,10 +682,29 @@ class Film(BasicParser):
                 self.get_mpaa(second_column)
 
     def parse(self):
-        self.parse_title()
-        self.parse_info()
-        self.get_cast()
-        self.get_ratings()
-        self.get_dates()
-        self.get_production_status()
-        self.get_boxes()
+        start = time.time()
+        with metrics.timer('film_step_seconds', step='title'):
+            self.parse_title()
+        with metrics.timer('film_step_seconds', step='info'):
+            self.parse_info()
+        if self.workers > 1:
+            # Все дополнительные страницы фильма запрашиваются одновременно,
+            # разбор каждой начинается, как только она загружена
+            with ThreadPoolExecutor(max_workers=self.workers) as self.executor:
+                self.prefetch([self.get_cast_url(), self.get_dates_url(),
+                               self.get_boxes_url()])
+                self.parse_pages()
+            self.executor = None
+        else:
+            self.parse_pages()
+        metrics.observe('film_fetch_seconds', self.fetch_time)
+        metrics.observe('film_parse_seconds', time.time() - start - self.fetch_time)
+
+    def parse_pages(self):
+        for step, parse in (('cast', self.get_cast),
+                            ('ratings', self.get_ratings),
+                            ('dates', self.get_dates),
+                            ('production_status', self.get_production_status),
+                            ('boxes', self.get_boxes)):
+            with metrics.timer('film_step_seconds', step=step):
+                parse()
@@ -10,7 +10,7 @@ unhtml_map = {
 }
 
 headers = {'User-agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) '
-           'Chrome/34.0.1847.132 Safari/537.36', 'Connection': 'close'}
+           'Chrome/34.0.1847.132 Safari/537.36'}
 
 
 def unhtml(input_string):
@@ -0,0 +1,152 @@
+# -*- encoding: utf-8 -*-
+
+import re
+import logging
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from lxml import etree
+
+from parselab.network import PageNotFound
+
+from mdb.db import Database
+from mdb.metrics import Metrics
+
+db = Database.Instance()
+metrics = Metrics.Instance()
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+iso_date_regexp = re.compile(r'^(\d{4})-(\d{2})-(\d{2})')
+dotted_date_regexp = re.compile(r'^(\d{2})\.(\d{2})\.(\d{4})')
+
+
+def parse_day(text):
+    text = (text or '').strip()
+    m = iso_date_regexp.match(text)
+    if m is not None:
+        return date(int(m.group(1)), int(m.group(2)), int(m.group(3)))
+    m = dotted_date_regexp.match(text)
+    if m is not None:
+        return date(int(m.group(3)), int(m.group(2)), int(m.group(1)))
+    return None
+
+
+def parse_history(source, last_day=None, graph='1'):
+    """
+    Parses rating variation XML of a film read from the file-like source,
+    yields (day, rating) newer than last_day. Days of points are listed in
+    <series> before the graphs, each <value> of the graph refers to its day
+    by xid. Elements are dropped as soon as they are parsed, only days newer
+    than last_day are kept until the rating graph is read.
+    """
+    days = dict()
+    for event, elem in etree.iterparse(source, events=('end',), tag='value'):
+        parent = elem.getparent()
+        xid = elem.get('xid')
+        if parent.tag == 'series':
+            day = parse_day(elem.text)
+            if day is not None and (last_day is None or day > last_day):
+                days[xid] = day
+        elif parent.tag == 'graph' and parent.get('gid') == graph and xid in days:
+            try:
+                yield days[xid], float(elem.text)
+            except (TypeError, ValueError):
+                pass
+        elem.clear()
+        while elem.getprevious() is not None:
+            del parent[0]
+
+
+class RatingHistoryLoader(object):
+    """
+    Appends rating history of films to mdb.rating_history (--rating-history).
+    Films are streamed from a server-side cursor together with the last
+    stored day of their history, variation XML of `concurrency` films is
+    fetched and parsed at once, and only points newer than the last stored
+    day are kept. Points are loaded with COPY every `batch_size` points
+    through a staging table, so a point loaded by another host meanwhile
+    is skipped instead of failing the batch.
+    """
+
+    def __init__(self, app, concurrency=1, batch_size=10000):
+        self.app = app
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.points = list()
+        self.saved = 0
+        self.failed = 0
+
+    def get_url(self, film_id):
+        return '%s/graph_data/variation_data_film/%s/variation_data_film_%s.xml' \
+               % (self.app.base, str(film_id)[-3:], film_id)
+
+    def get_films(self, from_id, to_id):
+        query = "select m.id, (select max(day) from mdb.rating_history h " \
+                "               where h.movie_id = m.id) " \
+                "  from mdb.movie m " \
+                " where m.id between %s and coalesce(%s, 999999999) " \
+                " order by m.id"
+        for row in db.query_iter(query, [from_id, to_id]):
+            yield row[0], row[1]
+
+    def get_last_day(self, film_id):
+        return db.query_value('select max(day) from mdb.rating_history where movie_id = %s',
+                              [film_id])
+
+    def get_points(self, film_id, last_day):
+        logger.info('Loading rating history of film %s after %s' % (film_id, last_day,))
+        try:
+            response = self.app.get_stream(self.get_url(film_id))
+        except PageNotFound:
+            return []
+        try:
+            return [(film_id, day, rating)
+                    for day, rating in parse_history(response.raw, last_day)]
+        finally:
+            response.close()
+
+    def load(self, film_id):
+        self.points = self.get_points(film_id, self.get_last_day(film_id))
+        self.flush()
+
+    def run(self, from_id, to_id):
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = deque()
+            for id, last_day in self.get_films(from_id, to_id):
+                futures.append((id, executor.submit(self.get_points, id, last_day)))
+                if len(futures) >= self.concurrency * 2:
+                    self.add(*futures.popleft())
+            while futures:
+                self.add(*futures.popleft())
+        self.flush()
+        logger.warning('Done, %s rating points saved, %s films failed'
+                       % (self.saved, self.failed,))
+
+    def add(self, id, future):
+        try:
+            self.points.extend(future.result())
+        except Exception as e:
+            self.failed += 1
+            self.app.log_error(id, 'Could not load rating history: %s' % str(e))
+        if len(self.points) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.points:
+            return
+        with metrics.timer('rating_history_save_seconds'):
+            with db.transaction():
+                db.execute('create temporary table stage_rating_history on commit drop as '
+                           'select movie_id, day, rating from mdb.rating_history with no data',
+                           [])
+                db.copy('stage_rating_history', ['movie_id', 'day', 'rating'], self.points)
+                db.execute('insert into mdb.rating_history (movie_id, day, rating) '
+                           'select movie_id, day, rating from stage_rating_history '
+                           'on conflict (movie_id, day) do nothing', [])
+        metrics.inc('rating_points_saved_total', len(self.points))
+        self.saved += len(self.points)
+        logger.warning('%s rating points saved' % self.saved)
+        self.points = list()
@@ -0,0 +1,78 @@
+# -*- encoding: utf-8 -*-
+
+import logging
+
+from mdb.db import Database
+from mdb.singleton import Singleton
+
+db = Database.Instance()
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class IdSet(object):
+    """
+    Compact set of non-negative integer IDs, one bit per ID, so a million
+    of IDs takes a few hundred kilobytes
+    """
+
+    def __init__(self, ids=None):
+        self.bits = bytearray()
+        if ids is not None:
+            self.update(ids)
+
+    def add(self, id):
+        byte = id >> 3
+        if byte >= len(self.bits):
+            self.bits.extend(bytes(byte - len(self.bits) + 1 + len(self.bits) // 2))
+        self.bits[byte] |= 1 << (id & 7)
+
+    def update(self, ids):
+        for id in ids:
+            self.add(id)
+
+    def __contains__(self, id):
+        byte = id >> 3
+        return byte < len(self.bits) and self.bits[byte] & (1 << (id & 7)) != 0
+
+
+@Singleton
+class Known(object):
+    """
+    Process-wide sets of IDs which are already stored in the database.
+    Rows with these IDs are not inserted again, so most films skip
+    dictionary queries entirely. IDs are added only after the transaction
+    which inserted them has been committed.
+    """
+
+    def __init__(self):
+        self.countries = set()
+        self.genres = set()
+        self.persons = IdSet()
+        # Загружается только по требованию, см. load_movies()
+        self.movies = None
+
+    def load(self):
+        self.countries = set(row[0] for row in db.query('select id from mdb.country'))
+        self.genres = set(row[0] for row in db.query('select id from mdb.genre'))
+        logger.info('Loaded %s countries and %s genres' % (len(self.countries), len(self.genres),))
+        self.persons = IdSet(row[0] for row in db.query_iter('select id from mdb.person'))
+        logger.info('Loaded persons, %s KB' % (len(self.persons.bits) // 1024))
+
+    def load_movies(self):
+        self.movies = IdSet(row[0] for row in db.query_iter('select id from mdb.movie'))
+        logger.info('Loaded movies, %s KB' % (len(self.movies.bits) // 1024))
+
+    def add_movies(self, ids):
+        if self.movies is not None:
+            self.movies.update(ids)
+
+    def filter_countries(self, rows):
+        return [row for row in rows if row[0] not in self.countries]
+
+    def filter_genres(self, rows):
+        return [row for row in rows if row[0] not in self.genres]
+
+    def filter_persons(self, rows):
+        return [row for row in rows if row[0] not in self.persons]
@@ -0,0 +1,182 @@
+# -*- encoding: utf-8 -*-
+
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# Типы страниц и шаблоны их адресов, к адресу может быть добавлена "соль"
+# через двоеточие (например, вторая страница состава)
+site = r'^https?://www\.kinopoisk\.ru'
+film = site + r'/film/(?:[^/]*-)?(\d+)/'
+page_types = [('film', re.compile(film + r'(?::.*)?$')),
+              ('cast', re.compile(film + r'cast/(?::.*)?$')),
+              ('who_is', re.compile(film + r'cast/who_is/')),
+              ('dates', re.compile(film + r'dates/')),
+              ('box', re.compile(film + r'box/')),
+              ('person', re.compile(site + r'/name/(\d+)/')),
+              ('history', re.compile(site + r'/graph_data/variation_data_film/\d+/'
+                                            r'variation_data_film_(\d+)\.xml')),
+              ('listing', re.compile(site + r'/lists/'))]
+
+
+def get_content_hash(data):
+    """
+    Returns hash of page content, None for content which is not text or bytes
+    """
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    if not isinstance(data, bytes):
+        return None
+    return hashlib.md5(data).hexdigest()
+
+
+def classify(url):
+    """
+    Returns page type, film ID and person ID of the URL
+    """
+    for page_type, regexp in page_types:
+        m = regexp.match(url)
+        if m is None:
+            continue
+        if page_type == 'person':
+            return page_type, None, int(m.group(1))
+        if page_type == 'listing':
+            return page_type, None, None
+        return page_type, int(m.group(1)), None
+    return 'other', None, None
+
+
+class Manifest(object):
+    """
+    Index of the page cache: every page written into the cache is recorded
+    with its URL, hash, film or person ID, page type, size, fetch time and
+    hash of the content, so the cache can be searched without scanning the
+    file system. ETag and Last-Modified of the page are recorded when it is
+    revalidated.
+    The index is an SQLite database in the cache directory, shared by all
+    processes which use the cache.
+    """
+
+    def __init__(self, path):
+        self.filename = os.path.join(path, 'manifest.sqlite')
+        self.lock = threading.RLock()
+        self.pid = None
+
+    def connect(self):
+        """
+        Opens the index, also after fork, because SQLite connection
+        may not be shared with the parent process
+        """
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        self.index = sqlite3.connect(self.filename, timeout=60, check_same_thread=False)
+        self.index.execute('pragma journal_mode = wal')
+        self.index.execute('pragma synchronous = normal')
+        self.index.execute('create table if not exists entry (url text primary key, '
+                           'hash text not null, film_id integer, person_id integer, '
+                           'page_type text not null, size integer not null, '
+                           'fetch_time real not null)')
+        # Колонки, добавленные после появления индекса
+        columns = [row[1] for row in self.index.execute('pragma table_info(entry)')]
+        for column in ('content_hash', 'etag', 'last_modified'):
+            if column not in columns:
+                self.index.execute('alter table entry add column %s text' % column)
+        self.index.execute('create index if not exists entry_film_id on entry (film_id)')
+        self.index.execute('create index if not exists entry_person_id on entry (person_id)')
+        self.index.execute('create index if not exists entry_hash on entry (hash)')
+        self.index.commit()
+
+    def get_row(self, url, size, fetch_time=None, content_hash=None):
+        page_type, film_id, person_id = classify(url)
+        return (url, hashlib.md5(url.encode('utf-8')).hexdigest(), film_id, person_id,
+                page_type, size, fetch_time or time.time(), content_hash)
+
+    def add(self, url, size, fetch_time=None, content_hash=None):
+        self.add_many([(url, size, fetch_time, content_hash)])
+
+    def add_many(self, entries):
+        """
+        Records entries given as (url, size, fetch_time) or
+        (url, size, fetch_time, content_hash) in one transaction
+        """
+        rows = [self.get_row(*entry) for entry in entries]
+        with self.lock:
+            self.connect()
+            self.index.executemany('insert or replace into entry (url, hash, film_id, person_id, '
+                                   'page_type, size, fetch_time, content_hash) '
+                                   'values (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            self.index.commit()
+
+    def get_validators(self, url):
+        """
+        Returns (etag, last_modified, content_hash) of the page
+        """
+        rows = self.query('select etag, last_modified, content_hash from entry where url = ?',
+                          [url])
+        return rows[0] if rows else (None, None, None)
+
+    def set_validators(self, url, etag, last_modified, content_hash=None):
+        # Ответ 304 может прийти без ETag и Last-Modified, тогда сохранённые
+        # значения остаются в силе для следующих условных запросов
+        with self.lock:
+            self.connect()
+            self.index.execute('update entry set etag = coalesce(?, etag), '
+                               'last_modified = coalesce(?, last_modified), '
+                               'content_hash = coalesce(?, content_hash), fetch_time = ? '
+                               'where url = ?',
+                               [etag, last_modified, content_hash, time.time(), url])
+            self.index.commit()
+
+    def remove(self, url):
+        with self.lock:
+            self.connect()
+            self.index.execute('delete from entry where url = ?', [url])
+            self.index.commit()
+
+    def query(self, query, params=None):
+        with self.lock:
+            self.connect()
+            return self.index.execute(query, params or []).fetchall()
+
+    def get_entry(self, url):
+        rows = self.query('select url, hash, film_id, person_id, page_type, size, fetch_time '
+                          'from entry where url = ?', [url])
+        return rows[0] if rows else None
+
+    def get_film_entries(self, film_id):
+        """
+        Returns (url, hash, page_type, size) of all cached pages of the film
+        """
+        return self.query('select url, hash, page_type, size from entry '
+                          'where film_id = ? order by url', [film_id])
+
+    def get_film_ids(self, from_id=None, to_id=None):
+        """
+        Returns IDs of films whose main page is cached
+        """
+        return [row[0] for row in
+                self.query('select film_id from entry where page_type = \'film\' '
+                           'and film_id between ? and ? group by film_id order by film_id',
+                           [from_id or 0, to_id or 2 ** 62])]
+
+    def get_count(self):
+        return self.query('select count(*) from entry')[0][0]
+
+
+# Все экземпляры кэша одного процесса используют общий индекс
+manifests = dict()
+
+
+def get_manifest(path):
+    if path not in manifests:
+        manifests[path] = Manifest(path)
+    return manifests[path]
@@ -0,0 +1,179 @@
+# -*- encoding: utf-8 -*-
+
+import time
+import logging
+import threading
+
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from mdb.singleton import Singleton
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+
+@Singleton
+class Metrics(object):
+    """
+    Process-wide counters and latency histograms of the crawler: page
+    requests, parse and save steps of films, captcha solving. Metrics are
+    exported in Prometheus text format by serve() and summarized by
+    get_summary().
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = dict()
+        self.histograms = dict()
+        self.summary_time = time.time()
+        self.summary_values = dict()
+
+    def get_key(self, name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def inc(self, name, value=1, **labels):
+        key = self.get_key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = self.get_key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def get_counter(self, name, **labels):
+        """
+        Returns sum of the counter over all label values matching `labels`
+        """
+        with self.lock:
+            return sum(value for (key, key_labels), value in self.counters.items()
+                       if key == name and set(labels.items()) <= set(key_labels))
+
+    def get_histogram(self, name, **labels):
+        """
+        Returns (sum, count) of the histogram over all label values matching `labels`
+        """
+        with self.lock:
+            found = [h for (key, key_labels), h in self.histograms.items()
+                     if key == name and set(labels.items()) <= set(key_labels)]
+            return sum(h.sum for h in found), sum(h.count for h in found)
+
+    def format_labels(self, labels, extra=None):
+        labels = list(labels) + (extra or [])
+        if not labels:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('"', '\\"'))
+                                 for key, value in labels)
+
+    def render(self):
+        """
+        Returns all metrics in Prometheus text exposition format
+        """
+        lines = list()
+        with self.lock:
+            names = sorted(set(key for key, labels in self.counters))
+            for name in names:
+                lines.append('# TYPE mdb_%s counter' % name)
+                for (key, labels), value in sorted(self.counters.items()):
+                    if key == name:
+                        lines.append('mdb_%s%s %s' % (name, self.format_labels(labels), value))
+            names = sorted(set(key for key, labels in self.histograms))
+            for name in names:
+                lines.append('# TYPE mdb_%s histogram' % name)
+                for (key, labels), h in sorted(self.histograms.items(), key=lambda i: i[0]):
+                    if key != name:
+                        continue
+                    count = 0
+                    for bound, bucket in zip(buckets, h.counts):
+                        count += bucket
+                        le = '+Inf' if bound == float('inf') else str(bound)
+                        lines.append('mdb_%s_bucket%s %s'
+                                     % (name, self.format_labels(labels, [('le', le)]), count))
+                    lines.append('mdb_%s_sum%s %s' % (name, self.format_labels(labels), h.sum))
+                    lines.append('mdb_%s_count%s %s' % (name, self.format_labels(labels), h.count))
+        return '\n'.join(lines) + '\n'
+
+    def get_summary(self):
+        """
+        Returns figures for the time since the previous call: requests per
+        second, cache hit ratio, parse and database milliseconds per film
+        """
+        values = {'requests': self.get_counter('page_requests_total'),
+                  'cache_hits': self.get_counter('page_requests_total', source='cache'),
+                  'captcha': self.get_counter('captcha_pages_total'),
+                  'films_parsed': self.get_histogram('film_parse_seconds')[1],
+                  'parse_seconds': self.get_histogram('film_parse_seconds')[0],
+                  'films_saved': self.get_counter('films_saved_total'),
+                  'save_seconds': self.get_histogram('save_seconds')[0]}
+        now = time.time()
+        delta = dict((key, value - self.summary_values.get(key, 0))
+                     for key, value in values.items())
+        seconds = max(now - self.summary_time, 0.001)
+        self.summary_time, self.summary_values = now, values
+
+        def ratio(a, b, scale=1):
+            return round(a * scale / b, 3) if b > 0 else None
+
+        return {'requests_per_sec': ratio(delta['requests'], seconds),
+                'cache_hit_ratio': ratio(delta['cache_hits'], delta['requests']),
+                'parse_ms_per_film': ratio(delta['parse_seconds'], delta['films_parsed'], 1000),
+                'db_ms_per_film': ratio(delta['save_seconds'], delta['films_saved'], 1000),
+                'films_per_sec': ratio(delta['films_saved'], seconds),
+                'captcha': delta['captcha']}
+
+    def serve(self, port, host=''):
+        """
+        Starts HTTP server with /metrics endpoint in a background thread
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logger.info('Metrics are available at http://%s:%s/metrics' % (host or '0.0.0.0', port,))
+        return server
@@ -0,0 +1,157 @@
+# -*- encoding: utf-8 -*-
+
+import random
+import logging
+import threading
+
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError
+from parselab.network import NetworkManager, PageNotFound, InternalServerError, headers
+
+from mdb.session import Session
+from mdb.ratelimit import RateLimiter
+
+limiter = RateLimiter.Instance()
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# Сетевой менеджер, общий для всех потоков процесса, см. get_network_manager()
+shared = {'pool_size': 10, 'manager': None}
+shared_lock = threading.Lock()
+
+
+class OfflineNetworkManager(NetworkManager):
+    """
+    Network manager which never goes to the network, used to build objects
+    purely from cached pages. A page missing from the cache is reported
+    as not found.
+    """
+
+    def __init__(self):
+        self.proxies = {}
+
+    def download_page(self, url, *args, **kwargs):
+        raise PageNotFound('Page "%s" is not cached' % url)
+
+    def post_page(self, url, data):
+        raise PageNotFound('Page "%s" is not cached' % url)
+
+
+class SessionNetworkManager(NetworkManager):
+    """
+    Network manager whose session is synchronized with the session store,
+    so cookies of a solved captcha are shared by all workers. Connections
+    are kept alive and reused, at most `pool_size` per host; when all of
+    them are busy a request waits for a free one.
+    """
+
+    def __init__(self, proxies={}, pool_size=10):
+        NetworkManager.__init__(self, proxies)
+        self.session = Session()
+        adapter = HTTPAdapter(pool_maxsize=pool_size, pool_block=True)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def download_page(self, url, cookies=None, binary=False):
+        """
+        Fetches the page once, returns None if it should be requested again,
+        parselab then retries the request. Connection errors and answers
+        other than 200, 404 and 500, such as 429 Too Many Requests or 503,
+        slow the rate limiter down, and the retry waits for its turn like
+        any other request.
+        """
+        proxies = dict(https=random.choice(self.proxies)) if self.proxies else None
+        try:
+            response = self.session.get(url, headers=headers, proxies=proxies)
+        except ConnectionError as e:
+            logger.warning('Connection error: %s' % e)
+            response = None
+        if response is not None:
+            logger.info('Page fetched with HTTP status code = %s' % response.status_code)
+            if response.status_code == 200:
+                return response if binary else response.text
+            elif response.status_code == 404:
+                raise PageNotFound('Page not found')
+            elif response.status_code == 500:
+                raise InternalServerError
+        limiter.backoff(url, 'error')
+        limiter.acquire(url)
+        return None
+
+    def revalidate(self, url, etag=None, last_modified=None):
+        """
+        Requests the page only if it was changed since it was fetched with
+        the given ETag or Last-Modified. Returns (page, etag, last_modified),
+        page is None if the site answered 304 Not Modified.
+        """
+        request_headers = dict(headers)
+        if etag is not None:
+            request_headers['If-None-Match'] = etag
+        if last_modified is not None:
+            request_headers['If-Modified-Since'] = last_modified
+        proxies = dict(https=random.choice(self.proxies)) if self.proxies else None
+        response = self.session.get(url, headers=request_headers, proxies=proxies)
+        logger.info('Page revalidated with HTTP status code = %s' % response.status_code)
+        if response.status_code == 404:
+            raise PageNotFound('Page not found')
+        elif response.status_code >= 500:
+            raise InternalServerError
+        elif response.status_code not in (200, 304):
+            raise Exception('Unexpected HTTP status code %s' % response.status_code)
+        page = response.text if response.status_code == 200 else None
+        return page, response.headers.get('ETag'), response.headers.get('Last-Modified')
+
+    def post_page(self, url, data):
+        """
+        Sends the form data to the url, returns the page
+        """
+        proxies = dict(https=random.choice(self.proxies)) if self.proxies else None
+        response = self.session.post(url, data=data, headers=headers, proxies=proxies)
+        logger.info('Page posted with HTTP status code = %s' % response.status_code)
+        if response.status_code == 404:
+            raise PageNotFound('Page not found')
+        elif response.status_code >= 500:
+            raise InternalServerError
+        elif response.status_code != 200:
+            raise Exception('Unexpected HTTP status code %s' % response.status_code)
+        return response.text
+
+    def open_stream(self, url):
+        """
+        Requests the page without reading its body, which is then read from
+        response.raw as it arrives. The response must be closed by the caller.
+        """
+        proxies = dict(https=random.choice(self.proxies)) if self.proxies else None
+        response = self.session.get(url, headers=headers, proxies=proxies, stream=True)
+        logger.info('Stream opened with HTTP status code = %s' % response.status_code)
+        if response.status_code != 200:
+            response.close()
+        if response.status_code == 404:
+            raise PageNotFound('Page not found')
+        elif response.status_code >= 500:
+            raise InternalServerError
+        elif response.status_code != 200:
+            raise Exception('Unexpected HTTP status code %s' % response.status_code)
+        response.raw.decode_content = True
+        return response
+
+
+def set_pool_size(pool_size):
+    """
+    Sets size of the connection pool of the shared network manager,
+    must be called before it is created
+    """
+    shared['pool_size'] = pool_size
+
+
+def get_network_manager():
+    """
+    Returns network manager shared by all parsers of the process, so film,
+    cast, dates, box and person pages are fetched over the same connections
+    """
+    with shared_lock:
+        if shared['manager'] is None:
+            shared['manager'] = SessionNetworkManager(pool_size=shared['pool_size'])
+            logger.info('Network manager initialized, pool size = %s' % shared['pool_size'])
+        return shared['manager']
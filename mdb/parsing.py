@@ -0,0 +1,180 @@
+# -*- encoding: utf-8 -*-
+
+import time
+import logging
+import threading
+
+from parselab.network import InternalServerError
+from parselab.parsing import BasicParser
+
+from mdb.captcha import CaptchaService, CaptchaError
+from mdb.manifest import classify, get_content_hash
+from mdb.metrics import Metrics
+from mdb.ratelimit import RateLimiter
+
+metrics = Metrics.Instance()
+limiter = RateLimiter.Instance()
+captcha = CaptchaService.Instance()
+
+# Адрес запрашиваемой страницы и число решённых для неё капч, у каждого потока свои
+local = threading.local()
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class CaptchaRequired(Exception):
+    pass
+
+
+class Parser(BasicParser):
+    """
+    Base class of App, Film and Person: counts page requests by page type
+    and source (cache or network), measures their latency, paces network
+    requests with the shared rate limiter and waits for captcha solutions
+    """
+
+    # Сколько раз подряд решать капчу для одной страницы
+    captcha_tries = 3
+
+    def get_sleep_time(self):
+        # Паузы между запросами к сайту выдерживает RateLimiter,
+        # страницы из кэша отдаются без ожидания
+        return 0
+
+    def is_captcha_required(self, data):
+        if isinstance(data, str) and 'captchaimg' in data:
+            metrics.inc('captcha_pages_total')
+            limiter.backoff(local.url, 'captcha')
+            return True
+        return False
+
+    def solve_captcha(self, data):
+        """
+        Blocks the calling thread until the captcha is solved in background,
+        the page is then requested again
+        """
+        local.captchas += 1
+        if local.captchas > self.captcha_tries:
+            raise CaptchaRequired('Captcha is still required after %s solutions'
+                                  % self.captcha_tries)
+        try:
+            captcha.solve(self.net.session, local.url, data).result()
+        except CaptchaError as e:
+            raise CaptchaRequired('Captcha was not solved: %s' % e)
+
+    def revalidate(self, url):
+        """
+        Checks the cached page against the site, with ETag and Last-Modified
+        if the site sent them before, otherwise by hash of the page content.
+        A changed page replaces the cached one. Returns True if the page
+        was changed.
+        """
+        manifest = self.cache.manifest
+        etag, last_modified, content_hash = manifest.get_validators(url)
+        if content_hash is None:
+            content_hash = get_content_hash(self.cache.get_file(url))
+        page_type = classify(url)[0]
+        local.url, local.captchas = url, 0
+        limiter.acquire(url)
+        start = time.time()
+        result = 'error'
+        try:
+            while True:
+                page, new_etag, new_last_modified = self.net.revalidate(url, etag, last_modified)
+                if not self.is_captcha_required(page):
+                    break
+                self.solve_captcha(page)
+            limiter.success(url)
+            page_hash = get_content_hash(page)
+            changed = page is not None and page_hash != content_hash
+            if changed:
+                self.cache.write_to_cache(url, page)
+            manifest.set_validators(url, new_etag, new_last_modified, page_hash)
+            result = 'changed' if changed else 'unchanged'
+            return changed
+        except Exception as e:
+            metrics.inc('page_errors_total', type=page_type, error=e.__class__.__name__)
+            if isinstance(e, InternalServerError):
+                limiter.backoff(url, 'error')
+            raise
+        finally:
+            metrics.inc('page_revalidations_total', type=page_type, result=result)
+            metrics.observe('page_seconds', time.time() - start, type=page_type,
+                            source='revalidation')
+
+    def get_stream(self, url):
+        """
+        Requests the url from the site bypassing the cache and returns the
+        response with the body not read yet, for documents which are parsed
+        as they arrive. An HTML page received instead of the document is
+        checked for captcha.
+        """
+        page_type = classify(url)[0]
+        local.url, local.captchas = url, 0
+        limiter.acquire(url)
+        start = time.time()
+        try:
+            while True:
+                response = self.net.open_stream(url)
+                if 'html' not in response.headers.get('Content-Type', ''):
+                    break
+                page = response.text
+                response.close()
+                if not self.is_captcha_required(page):
+                    raise Exception('HTML page was received instead of the document')
+                self.solve_captcha(page)
+            limiter.success(url)
+            return response
+        except Exception as e:
+            metrics.inc('page_errors_total', type=page_type, error=e.__class__.__name__)
+            if isinstance(e, InternalServerError):
+                limiter.backoff(url, 'error')
+            raise
+        finally:
+            metrics.inc('page_requests_total', type=page_type, source='network')
+            metrics.observe('page_seconds', time.time() - start, type=page_type,
+                            source='network')
+
+    def post_page(self, url, key, data):
+        """
+        Returns page received by sending the form data to the url, such as
+        continuation of the cast, the page is cached under the key
+        """
+        if self.cache.is_in_cache(key):
+            return self.cache.get_file(key)
+        while True:
+            page = self.net.post_page(url, data)
+            if not self.is_captcha_required(page):
+                break
+            self.solve_captcha(page)
+        self.cache.write_to_cache(key, page)
+        return page
+
+    def get_page(self, url, *args, **kwargs):
+        salt = kwargs.get('salt')
+        key = url if salt is None else '%s:%s' % (url, salt)
+        page_type = classify(url)[0]
+        local.url, local.captchas = url, 0
+        source = 'cache' if self.cache.is_in_cache(key) else 'network'
+        if source == 'network':
+            limiter.acquire(url)
+        start = time.time()
+        try:
+            if kwargs.get('method') == 'POST':
+                data = self.post_page(url, key, kwargs.get('data'))
+            else:
+                data = super(Parser, self).get_page(url, *args, **kwargs)
+            if source == 'network':
+                limiter.success(url)
+            return data
+        except Exception as e:
+            metrics.inc('page_errors_total', type=page_type, error=e.__class__.__name__)
+            # Ответы, после которых parselab повторяет запрос, замедляют
+            # лимитер сразу, в SessionNetworkManager.download_page()
+            if isinstance(e, InternalServerError):
+                limiter.backoff(url, 'error')
+            raise
+        finally:
+            metrics.inc('page_requests_total', type=page_type, source=source)
+            metrics.observe('page_seconds', time.time() - start, type=page_type, source=source)
@@ -3,25 +3,34 @@
 import re
 import logging
 
+from lxml.etree import XPath
 from lxml.html import fromstring
 
 from mdb.db import Database
 from mdb.helpers import get_date
-
-from parselab.network import NetworkManager
-from parselab.parsing import BasicParser
+from mdb.cache import get_cache
+from mdb.parsing import Parser
+from mdb.network import get_network_manager
 
 db = Database.Instance()
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
+find_alternative_name = XPath('//span[@itemprop="alternateName"]')
+find_info_rows = XPath('//table[@class="info"]//tr')
+find_info_type = XPath('.//td[@class="type"]')
+find_birth_date = XPath('.//td[@class="birth"]')
+
+growth_regexp = re.compile(r'(\d+)\.(\d+) м', re.UNICODE)
+death_regexp = re.compile(r'^(.+)•', re.UNICODE)
+
 
-class Person(BasicParser):
+class Person(Parser):
 
     base = 'https://www.kinopoisk.ru'
 
-    def __init__(self, id):
+    def __init__(self, id, page=None, cache=None, net=None):
         self.id = id
         self.name = None
         self.alternative_name = None
@@ -31,37 +40,42 @@ class Person(BasicParser):
         self.death_place = None
         self.growth = None
 
-        self.cache = FileCache(namespace='kinopoisk', path=os.environ.get('CACHE_PATH'))
-        self.net = NetworkManager()
+        if cache is None:
+            cache = get_cache()
+        if net is None:
+            net = get_network_manager()
+        self.cache = cache
+        self.net = net
 
-        page = self.get_page('%s/name/%s/' % (self.base, id))
+        if page is None:
+            page = self.get_page('%s/name/%s/' % (self.base, id))
         self.parse(page)
 
     def parse(self, page):
         self.html = fromstring(page)
 
-        alternative_span = self.html.xpath('//span[@itemprop="alternateName"]')
+        alternative_span = find_alternative_name(self.html)
         if len(alternative_span) > 0:
             self.alternative_name = alternative_span[0].text_content()
 
-        for tr in self.html.xpath('//table[@class="info"]//tr'):
-            td = tr.xpath('.//td[@class="type"]')[0]
+        for tr in find_info_rows(self.html):
+            td = find_info_type(tr)[0]
             info_type = td.text_content()
             info = td.getnext().text_content()
             if info_type == u'дата рождения':
-                self.birth_date = tr.xpath('.//td[@class="birth"]')[0].get("birthdate")
+                self.birth_date = find_birth_date(tr)[0].get("birthdate")
                 if self.birth_date is not None and self.birth_date.startswith('-'):
                     self.birth_date = ('%s BC' % self.birth_date[1:])
                 logger.warning('Birth date = %s' % self.birth_date)
             elif info_type == u'место рождения':
                 self.birth_place = info
             elif info_type == u'рост':
-                m = re.search('(\d+)\.(\d+) м', info, re.UNICODE)
+                m = growth_regexp.search(info)
                 if m is not None:
                     self.growth = int(m.group(1)) * 100 + int(m.group(2))
             elif info_type == u'дата смерти':
                 logger.warning(info)
-                m = re.search(u'^(.+)•', info, re.UNICODE)
+                m = death_regexp.search(info)
                 if m is None:
                     date = get_date(info.strip()).get('date')
                 else:
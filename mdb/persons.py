@@ -0,0 +1,137 @@
+# -*- encoding: utf-8 -*-
+
+import logging
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from mdb.db import Database
+from mdb.person import Person
+from mdb.metrics import Metrics
+
+db = Database.Instance()
+metrics = Metrics.Instance()
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class PersonUpdater(object):
+    """
+    Fills extra info of persons (--persons). IDs of persons not parsed yet
+    are streamed from a server-side cursor, pages are fetched and parsed by
+    `concurrency` threads, parsed persons are written every `batch_size`
+    persons with a single UPDATE. Results are taken in the order of IDs, so
+    the last written ID is stored in mdb.person_checkpoint in the same
+    transaction, and a restarted run with the same range continues after it.
+    If the batch can not be written, persons are saved one by one and the
+    ones which fail are recorded in mdb.error.
+    """
+
+    def __init__(self, app, concurrency=1, batch_size=100):
+        self.app = app
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.persons = list()
+        self.saved = 0
+        self.failed = 0
+
+    def get_start_id(self, from_id, to_id):
+        row = db.query_dict('select from_id, to_id, last_id from mdb.person_checkpoint '
+                            'where hostname = %s', [self.app.args.hostname])
+        if row and row[0]['from_id'] == from_id and row[0]['to_id'] == to_id:
+            logger.warning('Continuing from person %s' % (row[0]['last_id'] + 1))
+            return row[0]['last_id'] + 1
+        return from_id
+
+    def get_ids(self, from_id, to_id):
+        query = "select id from mdb.person " \
+                " where id between %s and coalesce(%s, 999999999) " \
+                "   and parsed_extra = false " \
+                " order by id"
+        for row in db.query_iter(query, [from_id, to_id]):
+            yield row[0]
+
+    def get_person(self, id):
+        logger.info('Parsing person with ID = %s', id)
+        return Person(id)
+
+    def run(self, from_id, to_id):
+        self.from_id, self.to_id = from_id, to_id
+        last_id = None
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = deque()
+            for id in self.get_ids(self.get_start_id(from_id, to_id), to_id):
+                futures.append((id, executor.submit(self.get_person, id)))
+                # Впереди загружается не больше двух страниц на поток
+                if len(futures) >= self.concurrency * 2:
+                    last_id = self.add(*futures.popleft())
+            while futures:
+                last_id = self.add(*futures.popleft())
+        self.flush(last_id)
+        # Диапазон пройден целиком, следующий запуск начнёт его сначала
+        db.execute('delete from mdb.person_checkpoint where hostname = %s',
+                   [self.app.args.hostname])
+        logger.warning('Done, %s persons saved, %s failed' % (self.saved, self.failed,))
+
+    def add(self, id, future):
+        try:
+            self.persons.append(future.result())
+        except Exception as e:
+            self.failed += 1
+            self.app.log_error(id, 'Could not process person: %s' % str(e))
+        if len(self.persons) >= self.batch_size:
+            self.flush(id)
+        return id
+
+    def flush(self, last_id):
+        if last_id is None:
+            return
+        rows = [(person.id, person.alternative_name, person.birth_date, person.birth_place,
+                 person.growth, person.death_date, person.death_place)
+                for person in self.persons]
+        self.persons = list()
+        saved = 0
+        try:
+            with metrics.timer('person_save_seconds'):
+                with db.transaction():
+                    self.update(rows)
+                    self.save_checkpoint(last_id)
+            saved = len(rows)
+        except Exception as e:
+            # Одна неверная строка откатывает весь пакет: персоны сохраняются
+            # по одной, а не сохранившиеся записываются в mdb.error
+            logger.warning('Could not save %s persons at once, saving them one by one: %s'
+                           % (len(rows), str(e),))
+            for row in rows:
+                try:
+                    with db.transaction():
+                        self.update([row])
+                    saved += 1
+                except Exception as e:
+                    self.failed += 1
+                    self.app.log_error(row[0], 'Could not save person: %s' % str(e))
+            self.save_checkpoint(last_id)
+        metrics.inc('persons_saved_total', saved)
+        self.saved += saved
+        logger.warning('%s persons saved, last ID = %s' % (self.saved, last_id,))
+
+    def update(self, rows):
+        db.execute_values('update mdb.person p '
+                          '   set alternative_name = v.alternative_name, '
+                          '       birth_date = v.birth_date, birth_place = v.birth_place, '
+                          '       growth = v.growth, death_date = v.death_date, '
+                          '       death_place = v.death_place, '
+                          '       updated_at = now(), parsed_extra = true '
+                          '  from (values %s) as v(id, alternative_name, birth_date, '
+                          '       birth_place, growth, death_date, death_place) '
+                          ' where p.id = v.id',
+                          rows, template='(%s, %s, %s::date, %s, %s::integer, %s::date, %s)')
+
+    def save_checkpoint(self, last_id):
+        db.execute('insert into mdb.person_checkpoint (hostname, from_id, to_id, last_id) '
+                   'values (%s, %s, %s, %s) '
+                   'on conflict (hostname) do update set from_id = excluded.from_id, '
+                   'to_id = excluded.to_id, last_id = excluded.last_id, '
+                   'update_time = current_timestamp',
+                   [self.app.args.hostname, self.from_id, self.to_id, last_id])
@@ -0,0 +1,112 @@
+# -*- encoding: utf-8 -*-
+
+import time
+import logging
+import threading
+
+from urllib.parse import urlparse
+
+from mdb.singleton import Singleton
+from mdb.metrics import Metrics
+
+metrics = Metrics.Instance()
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class Bucket(object):
+    """
+    Token bucket of a single host. Tokens are reserved in advance, so
+    threads waiting for the same host are served in order of arrival.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.time = time.time()
+
+    def reserve(self):
+        """
+        Takes a token, returns time in seconds to wait until it is available
+        """
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.time) * self.rate)
+        self.time = now
+        self.tokens -= 1
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+@Singleton
+class RateLimiter(object):
+    """
+    Adaptive per-host request rate (AIMD): every clean network response
+    increases the rate by `increase` requests per second up to `max_rate`,
+    server errors divide it by `error_factor` and captcha by `captcha_factor`,
+    down to `min_rate`. Until configure() is called requests are not limited.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = dict()
+        self.min_rate = None
+        self.max_rate = None
+
+    def configure(self, min_rate, max_rate, increase=0.02, error_factor=2, captcha_factor=4,
+                  burst=1):
+        self.min_rate = min_rate
+        self.max_rate = max(max_rate, min_rate)
+        self.increase = increase
+        self.error_factor = error_factor
+        self.captcha_factor = captcha_factor
+        self.burst = burst
+        self.buckets = dict()
+
+    def get_bucket(self, url):
+        host = urlparse(url).netloc
+        if host not in self.buckets:
+            # Начинаем с минимальной скорости и разгоняемся, пока сайт отвечает без ошибок
+            self.buckets[host] = Bucket(self.min_rate, self.burst)
+        return host, self.buckets[host]
+
+    def acquire(self, url):
+        """
+        Waits until a request to the host of the url is allowed
+        """
+        if self.min_rate is None:
+            return
+        with self.lock:
+            host, bucket = self.get_bucket(url)
+            wait = bucket.reserve()
+        if wait > 0:
+            metrics.observe('rate_limit_wait_seconds', wait)
+            time.sleep(wait)
+
+    def set_rate(self, bucket, rate):
+        bucket.rate = min(max(rate, self.min_rate), self.max_rate)
+        return bucket.rate
+
+    def success(self, url):
+        if self.min_rate is None:
+            return
+        with self.lock:
+            host, bucket = self.get_bucket(url)
+            self.set_rate(bucket, bucket.rate + self.increase)
+
+    def backoff(self, url, reason):
+        """
+        Slows requests to the host of the url down after a server error
+        (reason is 'error') or captcha (reason is 'captcha')
+        """
+        if self.min_rate is None:
+            return
+        metrics.inc('rate_limit_backoffs_total', reason=reason)
+        factor = self.captcha_factor if reason == 'captcha' else self.error_factor
+        with self.lock:
+            host, bucket = self.get_bucket(url)
+            rate = self.set_rate(bucket, bucket.rate / factor)
+            # Накопленные токены не должны позволить сразу повторить запрос
+            bucket.tokens = min(bucket.tokens, 0)
+        logger.warning('Request rate for %s is decreased to %.3f requests/s because of %s'
+                       % (host, rate, reason,))
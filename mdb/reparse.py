@@ -0,0 +1,106 @@
+# -*- encoding: utf-8 -*-
+
+import os
+import logging
+
+from multiprocessing import Pool
+from socket import gethostname
+
+from mdb.db import Database
+from mdb.film import Film
+from mdb.network import OfflineNetworkManager
+from mdb.writer import FilmWriter
+from mdb.cache import get_cache
+
+db = Database.Instance()
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# Параметры рабочего процесса, задаются в init_worker()
+worker = dict()
+
+
+def init_worker(dsn, buffer_size):
+    db.connect(dsn)
+    worker['cache'] = get_cache()
+    worker['net'] = OfflineNetworkManager()
+    # Буфер сбрасывается из reparse_films(), чтобы посчитать несохранённые фильмы
+    worker['writer'] = FilmWriter(float('inf'), interval=float('inf'), on_error=log_error)
+    worker['buffer_size'] = buffer_size
+
+
+def log_error(id, message):
+    logger.error('Could not parse movie %s: "%s"' % (id, message,))
+    db.execute('insert into mdb.error(hostname, movie_id, message) '
+               'values (%s, %s, %s)', [gethostname(), id, message])
+
+
+def flush_films():
+    """
+    Writes buffered films, returns number of films which were not saved
+    """
+    return len(worker['writer'].flush())
+
+
+def reparse_films(ids):
+    """
+    Builds films with given IDs from cached pages and saves them,
+    returns numbers of saved and failed films
+    """
+    cache = worker['cache']
+    saved, failed = 0, 0
+    for id in ids:
+        url = 'https://www.kinopoisk.ru/film/%s/' % id
+        if not cache.is_in_cache(url):
+            continue
+        try:
+            film = Film(id, cache.get_file(url), cache=cache, net=worker['net'])
+            worker['writer'].add(film)
+            saved += 1
+        except Exception as e:
+            log_error(id, str(e))
+            failed += 1
+        if len(worker['writer'].films) >= worker['buffer_size']:
+            not_saved = flush_films()
+            saved, failed = saved - not_saved, failed + not_saved
+    not_saved = flush_films()
+    return saved - not_saved, failed + not_saved
+
+
+class Reparser(object):
+    """
+    Rebuilds films from the page cache without network access. Parsing is
+    CPU-bound, so film IDs are split into chunks which are processed by
+    a pool of worker processes, each with its own database connection.
+    """
+
+    def __init__(self, dsn, processes=None, chunk_size=100, buffer_size=100):
+        self.dsn = dsn
+        self.processes = processes or os.cpu_count()
+        self.chunk_size = chunk_size
+        self.buffer_size = buffer_size
+
+    def get_chunks(self, ids):
+        chunk = list()
+        for id in ids:
+            chunk.append(id)
+            if len(chunk) == self.chunk_size:
+                yield chunk
+                chunk = list()
+        if chunk:
+            yield chunk
+
+    def run(self, ids):
+        # Соединение с базой не должно наследоваться рабочими процессами
+        db.close()
+        saved, failed = 0, 0
+        with Pool(self.processes, initializer=init_worker,
+                  initargs=(self.dsn, self.buffer_size)) as pool:
+            for chunk_saved, chunk_failed in pool.imap_unordered(reparse_films,
+                                                                  self.get_chunks(ids)):
+                saved += chunk_saved
+                failed += chunk_failed
+                logger.warning('Reparsed %s films, %s failed' % (saved, failed,))
+        db.connect(self.dsn)
+        return saved, failed
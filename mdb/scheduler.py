@@ -0,0 +1,100 @@
+# -*- encoding: utf-8 -*-
+
+import time
+import logging
+
+from mdb.db import Database
+from mdb.metrics import Metrics
+
+db = Database.Instance()
+metrics = Metrics.Instance()
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class RefreshScheduler(object):
+    """
+    Refreshes films continuously within a budget of requests per hour
+    (--refresh --budget). Every round the films most in need of refresh are
+    chosen: priority of a film grows with the time since it was refreshed,
+    with the number of votes and is lower for films released long ago, so
+    popular and recent films are refreshed often and old obscure films
+    rarely. A round takes about `round_time` seconds of the budget, time of
+    the last refresh of each film is kept in mdb.movie_refresh.
+    """
+
+    round_time = 900
+    # Оценка числа запросов на фильм, по ней выбирается размер раунда
+    requests_per_film = 4
+
+    def __init__(self, app, budget):
+        self.app = app
+        self.rate = budget / 3600
+        # Бюджет можно израсходовать вперёд не больше, чем на минуту
+        self.burst = max(budget / 60, 1)
+        self.round_size = max(int(budget * self.round_time / 3600 / self.requests_per_film),
+                              app.args.concurrency)
+
+    def get_spent(self):
+        return metrics.get_counter('page_requests_total', source='network') + \
+               metrics.get_counter('page_revalidations_total')
+
+    def wait(self):
+        """
+        Waits until the budget allows the next film to be refreshed
+        """
+        while True:
+            over = self.get_spent() - self.spent - self.rate * (time.time() - self.start) - \
+                   self.burst
+            if over < 0:
+                return
+            metrics.observe('refresh_budget_wait_seconds', over / self.rate)
+            time.sleep(over / self.rate)
+
+    def get_films(self, from_id, to_id):
+        """
+        Chooses films of the next round and marks them as refreshed
+        """
+        query = "with chosen as ( " \
+                "select m.id " \
+                "  from mdb.movie m " \
+                "  left join mdb.movie_refresh r on r.movie_id = m.id " \
+                " where m.id between %s and coalesce(%s, 999999999) " \
+                " order by extract(epoch from now() - coalesce(r.refresh_time, m.update_date, " \
+                "                                               m.parse_date, 'epoch')) " \
+                "          * (1 + ln(1 + coalesce((select max(vote_count) " \
+                "                                    from mdb.movie_rating v " \
+                "                                   where v.movie_id = m.id), 0))) " \
+                "          / (1 + greatest(current_date - coalesce( " \
+                "                 least(m.world_premiere, (select min(premiere_date) " \
+                "                                            from mdb.premiere_date p " \
+                "                                           where p.movie_id = m.id)), " \
+                "                 make_date(nullif(m.year, 0), 1, 1), current_date), 0) " \
+                "             / 365.0) desc, m.id " \
+                " limit %s) " \
+                "insert into mdb.movie_refresh (movie_id) select id from chosen " \
+                "on conflict (movie_id) do update set refresh_time = now() " \
+                "returning movie_id"
+        return sorted(row[0] for row in db.query_dict(query, [from_id, to_id, self.round_size]))
+
+    def get_rounds(self, from_id, to_id):
+        while True:
+            # Обход идёт в отдельном потоке, запросы к базе выполняются
+            # в потоке сохранения фильмов, которому принадлежит соединение
+            ids = self.app.call_in_save_thread(self.get_films, from_id, to_id)
+            if not ids:
+                logger.warning('No films to refresh, waiting %s s' % self.round_time)
+                time.sleep(self.round_time)
+                continue
+            logger.warning('Refreshing %s films' % len(ids))
+            for id in ids:
+                self.wait()
+                metrics.inc('films_scheduled_total')
+                yield (id, None, None)
+            self.app.call_in_save_thread(self.app.update_metrics)
+
+    def run(self, from_id, to_id):
+        self.start = time.time()
+        self.spent = self.get_spent()
+        self.app.process_films(self.get_rounds(from_id, to_id))
@@ -0,0 +1,196 @@
+# -*- encoding: utf-8 -*-
+
+import os
+import json
+import time
+import fcntl
+import logging
+import threading
+import psycopg2
+import psycopg2.extensions
+import requests
+
+from mdb.singleton import Singleton
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class FileSessionBackend(object):
+    """
+    Keeps the session in a JSON file shared by all processes on the host.
+    Writers are serialized with a lock file, the file is replaced atomically,
+    so it is read without locking.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def save(self, state):
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            current = self.load()
+            state = dict(state, version=(current or {}).get('version', 0) + 1)
+            temp_filename = '%s.%s.tmp' % (self.path, os.getpid())
+            with open(temp_filename, 'w') as f:
+                json.dump(state, f)
+            os.rename(temp_filename, self.path)
+        return state['version']
+
+
+class DatabaseSessionBackend(object):
+    """
+    Keeps the session in mdb.session, shared by all hosts. Uses its own
+    connection, so the session is never saved inside a transaction of films.
+    """
+
+    def __init__(self, dsn, name='kinopoisk'):
+        self.dsn = dsn
+        self.name = name
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def get_cursor(self):
+        if self.conn is None or self.conn.closed:
+            self.conn = psycopg2.connect(self.dsn)
+            self.conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        return self.conn.cursor()
+
+    def load(self):
+        with self.lock:
+            cursor = self.get_cursor()
+            cursor.execute('select version, user_agent, cookies from mdb.session '
+                           'where name = %s', [self.name])
+            row = cursor.fetchone()
+            cursor.close()
+        if row is None:
+            return None
+        return {'version': row[0], 'user_agent': row[1], 'cookies': row[2]}
+
+    def save(self, state):
+        with self.lock:
+            cursor = self.get_cursor()
+            cursor.execute('insert into mdb.session (name, version, user_agent, cookies) '
+                           'values (%s, 1, %s, %s) '
+                           'on conflict (name) do update set version = mdb.session.version + 1, '
+                           'user_agent = excluded.user_agent, cookies = excluded.cookies, '
+                           'update_time = current_timestamp '
+                           'returning version',
+                           [self.name, state['user_agent'], json.dumps(state['cookies'])])
+            version = cursor.fetchone()[0]
+            cursor.close()
+        return version
+
+
+@Singleton
+class SessionStore(object):
+    """
+    Process-wide access to the stored session: cookies and User-Agent of
+    the crawler. A captcha solved by one worker is saved here, so that the
+    other workers reuse the solution instead of solving their own captchas.
+    Until configure() is called nothing is stored.
+    """
+
+    def __init__(self):
+        self.backend = None
+
+    def configure(self, backend):
+        self.backend = backend
+
+    def load(self):
+        if self.backend is None:
+            return None
+        try:
+            return self.backend.load()
+        except Exception as e:
+            logger.error('Could not load session: %s' % e)
+            return None
+
+    def save(self, user_agent, cookies):
+        if self.backend is None:
+            return None
+        try:
+            return self.backend.save({'user_agent': user_agent, 'cookies': cookies})
+        except Exception as e:
+            logger.error('Could not save session: %s' % e)
+            return None
+
+
+store = SessionStore.Instance()
+
+
+class Session(requests.Session):
+    """
+    requests session synchronized with the session store: stored cookies
+    and User-Agent are picked up at most every `sync_interval` seconds,
+    changed cookies are saved after each response
+    """
+
+    sync_interval = 5
+
+    def __init__(self):
+        requests.Session.__init__(self)
+        self.user_agent = None
+        self.version = None
+        self.sync_time = 0
+        self.cookies_state = list()
+        self.sync_lock = threading.RLock()
+
+    def get_cookies_state(self):
+        return sorted([cookie.name, cookie.value, cookie.domain, cookie.path, cookie.expires,
+                       cookie.secure] for cookie in self.cookies)
+
+    def refresh(self, force=False):
+        """
+        Loads the stored session if it was changed by another worker,
+        returns True if it was
+        """
+        with self.sync_lock:
+            if not force and time.time() - self.sync_time < self.sync_interval:
+                return False
+            self.sync_time = time.time()
+            state = store.load()
+            if state is None or state['version'] == self.version:
+                return False
+            self.version = state['version']
+            self.user_agent = state['user_agent'] or self.user_agent
+            self.cookies.clear()
+            for name, value, domain, path, expires, secure in state['cookies']:
+                self.cookies.set(name, value, domain=domain, path=path, expires=expires,
+                                 secure=secure)
+            self.cookies_state = self.get_cookies_state()
+            logger.info('Session version %s is loaded' % self.version)
+            return True
+
+    def save(self):
+        with self.sync_lock:
+            cookies_state = self.get_cookies_state()
+            if cookies_state == self.cookies_state:
+                return
+            self.cookies_state = cookies_state
+            version = store.save(self.user_agent, cookies_state)
+            if version is not None:
+                self.version = version
+
+    def prepare_request(self, request):
+        prepared = requests.Session.prepare_request(self, request)
+        # Сохранённые cookies действительны вместе с User-Agent, с которым они получены
+        if self.user_agent is not None:
+            prepared.headers['User-Agent'] = self.user_agent
+        else:
+            self.user_agent = prepared.headers.get('User-Agent')
+        return prepared
+
+    def request(self, *args, **kwargs):
+        self.refresh()
+        try:
+            return requests.Session.request(self, *args, **kwargs)
+        finally:
+            self.save()
@@ -0,0 +1,90 @@
+# -*- encoding: utf-8 -*-
+
+import time
+import logging
+
+from mdb.db import Database
+
+db = Database.Instance()
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class WorkQueue(object):
+    """
+    Queue of listing pages shared by all parser.py processes through mdb.task.
+    A page is leased with FOR UPDATE SKIP LOCKED, so concurrent workers never
+    get the same page. The lease expires after `lease_time` seconds unless the
+    worker extends it with heartbeat(), after that the page is given to another
+    worker. A failed page is retried after `retry_delay` seconds, doubled on
+    every attempt. Pages which failed `max_attempts` times are not leased
+    anymore.
+    """
+
+    def __init__(self, hostname, lease_time=600, max_attempts=5, retry_delay=60):
+        self.hostname = hostname
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.heartbeat_time = 0
+
+    def fill(self, year, pages_count):
+        db.execute('insert into mdb.task (year, page) '
+                   'select %s, generate_series(1, %s) '
+                   'on conflict (year, page) do nothing', [year, pages_count])
+
+    def lease(self):
+        result = db.query_dict('update mdb.task '
+                               '   set leased_by = %s, attempts = attempts + 1, '
+                               '       lease_until = now() + %s * interval \'1 second\' '
+                               ' where id = (select id from mdb.task '
+                               '              where done_time is null '
+                               '                and attempts < %s '
+                               '                and (lease_until is null or lease_until < now()) '
+                               '              order by year, page '
+                               '              limit 1 '
+                               '                for update skip locked) '
+                               'returning id, year, page',
+                               [self.hostname, self.lease_time, self.max_attempts])
+        if not result:
+            return None
+        self.heartbeat_time = time.time()
+        return result[0]
+
+    def heartbeat(self, task):
+        """
+        Extends the lease, the database is touched not more often than
+        three times per lease period
+        """
+        if time.time() - self.heartbeat_time < self.lease_time / 3:
+            return
+        db.execute('update mdb.task set lease_until = now() + %s * interval \'1 second\' '
+                   'where id = %s and leased_by = %s',
+                   [self.lease_time, task['id'], self.hostname])
+        self.heartbeat_time = time.time()
+
+    def complete(self, task):
+        db.execute('update mdb.task set done_time = now(), lease_until = null '
+                   'where id = %s', [task['id']])
+
+    def release(self, task):
+        # Страница снова выдаётся только после паузы, иначе все попытки
+        # были бы израсходованы за несколько секунд
+        db.execute('update mdb.task '
+                   '   set leased_by = null, '
+                   '       lease_until = now() + %s * power(2, attempts - 1) '
+                   '                             * interval \'1 second\' '
+                   ' where id = %s and leased_by = %s',
+                   [self.retry_delay, task['id'], self.hostname])
+
+    def get_retry_wait(self):
+        """
+        Returns time in seconds until the next released page may be retried,
+        None if no page waits for retry
+        """
+        return db.query_value('select extract(epoch from min(lease_until) - now()) '
+                              '  from mdb.task '
+                              ' where done_time is null and leased_by is null '
+                              '   and attempts < %s and lease_until > now()',
+                              [self.max_attempts])
@@ -0,0 +1,234 @@
+# -*- encoding: utf-8 -*-
+
+import time
+import random
+import logging
+import psycopg2.errors
+
+from collections import OrderedDict
+
+from mdb.db import Database
+from mdb.known import Known
+from mdb.metrics import Metrics
+from mdb.film import cast_columns, dates_columns, boxes_columns, movie_changed, \
+    rating_changed, rows_match
+
+db = Database.Instance()
+known = Known.Instance()
+metrics = Metrics.Instance()
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class FilmWriter(object):
+    """
+    Write-behind buffer for parsed films. Films are kept in memory and written
+    every `size` films or `interval` seconds in one transaction: rows of all
+    buffered films are loaded into temporary tables with COPY and merged into
+    mdb tables with set-based statements. Films still in the buffer are lost
+    if the process dies, so flush() must be called before exit.
+    If the batch can not be written, films are saved one by one with
+    Film.save(), films which fail are passed to `on_error(id, message)`.
+    """
+
+    deadlock_tries = 3
+
+    def __init__(self, size=100, interval=60, on_error=None):
+        self.size = size
+        self.interval = interval
+        self.on_error = on_error
+        self.films = OrderedDict()
+        self.flushed_at = time.time()
+
+    def add(self, film):
+        # Фильм, попавший в буфер повторно, заменяет предыдущую версию
+        self.films.pop(film.id, None)
+        self.films[film.id] = film
+        if len(self.films) >= self.size or time.time() - self.flushed_at >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes buffered films, returns IDs of films which were not saved
+        """
+        films = list(self.films.values())
+        # Буфер очищается в любом случае, иначе фильм, который не удаётся
+        # записать, попадал бы во все следующие пакеты
+        self.films = OrderedDict()
+        self.flushed_at = time.time()
+        if not films:
+            return []
+        logger.info('Flushing %s films' % len(films))
+        try:
+            with metrics.timer('save_seconds', mode='writer'):
+                persons, countries, genres = self.write_batch(films)
+        except Exception as e:
+            logger.warning('Could not write %s films at once, saving them one by one: %s'
+                           % (len(films), str(e),))
+            metrics.inc('writer_fallbacks_total')
+            return self.save_each(films)
+        metrics.inc('films_saved_total', len(films), mode='writer')
+        known.add_movies([film.id for film in films])
+        known.persons.update(persons)
+        known.countries.update(countries)
+        known.genres.update(genres)
+        return []
+
+    def write_batch(self, films):
+        attempt = 1
+        while True:
+            try:
+                return self.write(films)
+            except psycopg2.errors.DeadlockDetected:
+                # Параллельные процессы вставляют одни и те же новые персоны,
+                # транзакция проигравшего откатывается и повторяется целиком
+                if attempt >= self.deadlock_tries:
+                    raise
+                metrics.inc('writer_deadlocks_total')
+                logger.warning('Deadlock while writing films, attempt %s' % attempt)
+                attempt += 1
+                time.sleep(random.uniform(0, attempt))
+
+    def save_each(self, films):
+        failed = list()
+        for film in films:
+            try:
+                film.save()
+            except Exception as e:
+                failed.append(film.id)
+                if self.on_error is not None:
+                    self.on_error(film.id, 'Could not save film: %s' % str(e))
+                else:
+                    logger.error('Could not save film %s: %s' % (film.id, str(e),))
+        return failed
+
+    def write(self, films):
+        with db.transaction():
+            with metrics.timer('writer_step_seconds', step='staging'):
+                self.create_staging_tables()
+            with metrics.timer('writer_step_seconds', step='copy'):
+                persons, countries, genres = self.copy_films(films)
+            with metrics.timer('writer_step_seconds', step='merge'):
+                self.merge()
+        return persons, countries, genres
+
+    def create_staging_tables(self):
+        db.execute('create temporary table stage_person on commit drop as '
+                   'select id, name, alternative_name from mdb.person with no data', [])
+        db.execute('create temporary table stage_movie on commit drop as '
+                   'select id, title, alternative_title, year, slogan, length, genres, '
+                   'rating_kinopoisk, rating_imdb, directors, scenario, operators, composers, '
+                   'producers, arts, editors, age_restriction, countries, rating_critics, '
+                   'world_premiere, rating_mpaa, production_status '
+                   'from mdb.movie with no data', [])
+        db.execute('create temporary table stage_premiere on commit drop as '
+                   'select movie_id, region, premiere_date, precision '
+                   'from mdb.premiere_date with no data', [])
+        db.execute('create temporary table stage_cast on commit drop as '
+                   'select movie_id, person_id, role, commentary '
+                   'from mdb.person_in_movie with no data', [])
+        db.execute('create temporary table stage_rating on commit drop as '
+                   'select movie_id, rating_system, rating, vote_count '
+                   'from mdb.movie_rating with no data', [])
+        db.execute('create temporary table stage_dates on commit drop as '
+                   'select movie_id, country_id, premiere_date, premiere_precision, viewers, '
+                   'commentary from mdb.movie_dates with no data', [])
+        db.execute('create temporary table stage_boxes on commit drop as '
+                   'select movie_id, category, item, value, currency '
+                   'from mdb.movie_boxes with no data', [])
+
+    def copy_films(self, films):
+        countries = dict()
+        genres = dict()
+        for film in films:
+            countries.update((row[0], row) for row in film.get_countries_rows())
+            genres.update((row[0], row) for row in film.get_genres_rows())
+
+        # Справочники маленькие, их проще дописать обычным запросом
+        # Строки справочников вставляются по порядку ID, чтобы параллельные
+        # процессы блокировали их в одном порядке и не попадали во взаимоблокировку
+        countries = sorted(known.filter_countries(countries.values()))
+        genres = sorted(known.filter_genres(genres.values()))
+        db.execute_values('insert into mdb.country(id, name) values %s on conflict do nothing',
+                          countries)
+        db.execute_values('insert into mdb.genre(id, name) values %s on conflict do nothing',
+                          genres)
+
+        persons = dict()
+        for film in films:
+            persons.update((row[0], row) for row in known.filter_persons(film.get_persons_rows()))
+        db.copy('stage_person', ['id', 'name', 'alternative_name'],
+                (persons[id] for id in sorted(persons)))
+        db.copy('stage_movie', ['id', 'title', 'alternative_title', 'year', 'slogan', 'length',
+                                'genres', 'rating_kinopoisk', 'rating_imdb', 'directors',
+                                'scenario', 'operators', 'composers', 'producers', 'arts',
+                                'editors', 'age_restriction', 'countries', 'rating_critics',
+                                'world_premiere', 'rating_mpaa', 'production_status'],
+                (film.get_movie_row() for film in films))
+        db.copy('stage_premiere', ['movie_id', 'region', 'premiere_date', 'precision'],
+                (row for film in films for row in film.get_premieres_rows()))
+        db.copy('stage_cast', ['movie_id', 'person_id', 'role', 'commentary'],
+                (row for film in films for row in film.get_cast_rows()))
+        db.copy('stage_rating', ['movie_id', 'rating_system', 'rating', 'vote_count'],
+                (row for film in films for row in film.get_ratings_rows()))
+        db.copy('stage_dates', ['movie_id', 'country_id', 'premiere_date', 'premiere_precision',
+                                'viewers', 'commentary'],
+                (row for film in films for row in film.get_dates_rows()))
+        db.copy('stage_boxes', ['movie_id', 'category', 'item', 'value', 'currency'],
+                (row for film in films for row in film.get_boxes_rows()))
+
+        return list(persons), [row[0] for row in countries], [row[0] for row in genres]
+
+    def merge(self):
+        db.execute('insert into mdb.person (id, name, alternative_name) '
+                   'select id, name, alternative_name from stage_person order by id '
+                   'on conflict (id) do nothing', [])
+        db.execute('insert into mdb.movie(id, title, alternative_title, year, slogan, '
+                   'length, genres, rating_kinopoisk, rating_imdb, '
+                   'directors, scenario, operators, composers, producers, arts, editors, '
+                   'age_restriction, countries, rating_critics, world_premiere, '
+                   'rating_mpaa, production_status) '
+                   'select * from stage_movie '
+                   'on conflict (id) do update set title = excluded.title, '
+                   'alternative_title = excluded.alternative_title, year = excluded.year, '
+                   'slogan = excluded.slogan, length = excluded.length, '
+                   'genres = excluded.genres, rating_kinopoisk = excluded.rating_kinopoisk, '
+                   'rating_imdb = excluded.rating_imdb, directors = excluded.directors, '
+                   'scenario = excluded.scenario, operators = excluded.operators, '
+                   'composers = excluded.composers, producers = excluded.producers, '
+                   'arts = excluded.arts, editors = excluded.editors, '
+                   'age_restriction = excluded.age_restriction, countries = excluded.countries, '
+                   'rating_critics = excluded.rating_critics, '
+                   'world_premiere = excluded.world_premiere, update_date = now(), '
+                   'rating_mpaa = excluded.rating_mpaa, '
+                   'production_status = excluded.production_status '
+                   'where ' + movie_changed, [])
+        db.execute('insert into mdb.premiere_date (movie_id, region, premiere_date, precision) '
+                   'select movie_id, region, premiere_date, precision from stage_premiere '
+                   'on conflict (movie_id, region) do nothing', [])
+        self.sync_rows('mdb.person_in_movie', 'stage_cast', cast_columns)
+        db.execute('insert into mdb.movie_rating (movie_id, rating_system, rating, vote_count) '
+                   'select distinct on (movie_id, rating_system) '
+                   '       movie_id, rating_system, rating, vote_count from stage_rating '
+                   'order by movie_id, rating_system '
+                   'on conflict (movie_id, rating_system) do update '
+                   'set rating = excluded.rating, vote_count = excluded.vote_count '
+                   'where ' + rating_changed, [])
+        self.sync_rows('mdb.movie_dates', 'stage_dates', dates_columns)
+        self.sync_rows('mdb.movie_boxes', 'stage_boxes', boxes_columns)
+
+    def sync_rows(self, table, stage, columns):
+        """
+        Brings rows of the buffered films in the child table to the staged rows:
+        deletes stored rows which were not staged and inserts staged rows which
+        are not stored, rows which did not change are not touched
+        """
+        names = ', '.join(name for name, type in columns)
+        match = rows_match(columns)
+        db.execute('delete from %s t using stage_movie m where t.movie_id = m.id '
+                   'and not exists (select 1 from %s v where v.movie_id = t.movie_id and %s)'
+                   % (table, stage, match), [])
+        db.execute('insert into %s (movie_id, %s) select movie_id, %s from %s v '
+                   'where not exists (select 1 from %s t where t.movie_id = v.movie_id and %s)'
+                   % (table, names, names, stage, table, match), [])
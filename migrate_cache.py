@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+
+import os
+import re
+import sys
+import logging
+import argparse
+
+from mdb.cache import get_cache
+from mdb.manifest import get_manifest
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class App():
+    """
+    Converts cache written by FileCache (one uncompressed file per page, named
+    by md5 of the URL) into the format set by CACHE_FORMAT under CACHE_PATH.
+    Manifest entries of the source directory are recorded for the migrated
+    pages, pages without them are counted and should be recorded afterwards
+    with build_manifest.py, otherwise --refresh loads them again.
+    """
+
+    def __init__(self):
+        parser = argparse.ArgumentParser(description='Page cache migration')
+        parser.add_argument('--source', type=str, required=True,
+                            help='Directory with cached files, searched recursively')
+        parser.add_argument('--format', type=str, required=False, default=None,
+                            help='Target cache format, defaults to CACHE_FORMAT')
+        parser.add_argument('--remove', required=False, default=False, action='store_true',
+                            help='Remove source files after migration')
+        self.args = parser.parse_args()
+        format = self.args.format or os.environ.get('CACHE_FORMAT', 'plain')
+        if format == 'plain':
+            parser.error('pages are already stored in the plain format, '
+                         'set target format with --format or CACHE_FORMAT')
+        self.cache = get_cache(format)
+        self.source_manifest = None
+        if os.path.exists(os.path.join(self.args.source, 'manifest.sqlite')):
+            self.source_manifest = get_manifest(self.args.source)
+
+    def get_files(self, path):
+        for entry in os.scandir(path):
+            if entry.is_dir(follow_symlinks=False):
+                for filename in self.get_files(entry.path):
+                    yield filename
+            elif re.match('^[0-9a-f]{32}$', entry.name):
+                yield entry.path
+
+    def get_entries(self, hash, size):
+        """
+        Returns manifest entries (url, size, fetch_time, content_hash) of the page
+        """
+        if self.source_manifest is None:
+            return []
+        return [(url, size, fetch_time, content_hash) for url, fetch_time, content_hash
+                in self.source_manifest.query('select url, fetch_time, content_hash '
+                                              'from entry where hash = ?', [hash])]
+
+    def run(self):
+        count = 0
+        entries = list()
+        unknown = 0
+        for filename in self.get_files(self.args.source):
+            hash = os.path.basename(filename)
+            if not self.cache.has_entry(hash) and os.path.getsize(filename) > 0:
+                with open(filename, 'rb') as f:
+                    data = f.read()
+                self.cache.write_entry(hash, data)
+                page_entries = self.get_entries(hash, len(data))
+                if not page_entries:
+                    unknown += 1
+                entries.extend(page_entries)
+            if os.path.exists('%s.error' % filename):
+                # Ошибки загрузки хранятся рядом со страницей, как и раньше
+                with open('%s.error' % filename) as f:
+                    error_filename = os.path.join(self.cache.path, hash[0:2], hash[2:4],
+                                                  hash + '.error')
+                    os.makedirs(os.path.dirname(error_filename), exist_ok=True)
+                    with open(error_filename, 'wt') as e:
+                        e.write(f.read())
+                if self.args.remove:
+                    os.remove('%s.error' % filename)
+            if self.args.remove:
+                os.remove(filename)
+            count += 1
+            if len(entries) >= 10000:
+                self.cache.manifest.add_many(entries)
+                entries = list()
+            if count % 10000 == 0:
+                logger.info('%s files migrated' % count)
+        self.cache.manifest.add_many(entries)
+        logger.info('Done, %s files migrated' % count)
+        if unknown > 0:
+            logger.warning('%s migrated pages are not in the manifest, '
+                           'run build_manifest.py to record them' % unknown)
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                        level=logging.INFO, stream=sys.stdout)
+    app = App()
+    app.run()
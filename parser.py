@@ -6,36 +6,72 @@ import re
 import sys
 import time
 import logging
-import shutil
-import requests
 import argparse
 from socket import gethostname
 from datetime import date
+from collections import OrderedDict
 
+from lxml.etree import XPath
 from lxml.html import fromstring
 
 import config
-from mdb.film import Film
-from mdb.person import Person
+from mdb.film import Film, find_subscribe_link, full_id_regexp
+from mdb.persons import PersonUpdater
+from mdb.history import RatingHistoryLoader
+from mdb.scheduler import RefreshScheduler
 from mdb.db import Database
-from mdb.captcha import CaptchaSolver
-
-from parselab.cache import FileCache
-from parselab.network import NetworkManager, PageNotFound, InternalServerError
-from parselab.parsing import BasicParser, ParsingDatabase, PageDownloadException
+from mdb.known import Known
+from mdb.captcha import CaptchaService
+from mdb.crawler import AsyncCrawler
+from mdb.writer import FilmWriter
+from mdb.workqueue import WorkQueue
+from mdb.reparse import Reparser
+from mdb.cache import get_cache
+from mdb.metrics import Metrics
+from mdb.parsing import Parser
+from mdb.ratelimit import RateLimiter
+from mdb.network import get_network_manager, set_pool_size
+from mdb.session import SessionStore, FileSessionBackend, DatabaseSessionBackend
+
+from parselab.network import PageNotFound, InternalServerError
+from parselab.parsing import ParsingDatabase, PageDownloadException
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
 db = Database.Instance()
+known = Known.Instance()
+metrics = Metrics.Instance()
+limiter = RateLimiter.Instance()
+captcha = CaptchaService.Instance()
+sessions = SessionStore.Instance()
+
+find_last_page = XPath('//div[@class="paginator"]//a[@class="paginator__page-number"][last()]')
+find_meta_info = XPath('//div[@class="selections-seo-page__meta-info"]')
+find_film_links = XPath('//div[contains(@class, "selections-film-item")]'
+                        '//a[@class="selection-film-item-meta__link"]')
+find_film_name = XPath('.//p[@class="selection-film-item-meta__name"]')
+
+old_film_url_regexp = re.compile(r'^/film/(\d+)/$')
+film_url_regexp = re.compile(r'-(\d+)/$')
+non_digits_regexp = re.compile(r'[^\d]')
 
 
-class App(BasicParser):
+class App(Parser):
 
     base = 'https://www.kinopoisk.ru'
     total_count = None
     current_page = None
     total_pages = None
+    done_count = 0
+    saved_count = 0
+    stat_time = 0
+    metrics_time = 0
+    last_movie_id = None
+    queue = None
+    task = None
+    crawler = None
+    listings_size = 8
 
     def __init__(self):
         parser = argparse.ArgumentParser(description='kinopoisk.ru parser')
@@ -43,21 +79,100 @@ class App(BasicParser):
         parser.add_argument('--hostname', type=str, help='Hostname', required=False,
                             default=gethostname())
         parser.add_argument('--film-id', type=int, help='Film ID')
-        parser.add_argument('--sleep-time', type=int, help='Max sleep time between requests',
-                            default=20)
+        parser.add_argument('--sleep-time', type=int, default=20,
+                            help='Max interval in seconds between requests to the site, '
+                                 'the request rate never drops below 1/sleep-time')
+        parser.add_argument('--max-rate', required=False, default=2, type=float,
+                            help='Max number of requests per second to the site, the rate '
+                                 'grows up to it while there are no captcha or server errors')
         parser.add_argument('--total', required=False, default=False, action='store_true')
         parser.add_argument('--read-only', required=False, default=False, action='store_true')
         parser.add_argument('--update', required=False, default=False, action='store_true')
         parser.add_argument('--start-page', required=False, default=1, type=int)
         parser.add_argument('--persons', required=False, default=False, action='store_true')
         parser.add_argument('--from-id', required=False, default=1, type=int)
-        parser.add_argument('--to-id', required=False, default=None)
+        parser.add_argument('--to-id', required=False, default=None, type=int)
+        parser.add_argument('--concurrency', required=False, default=1, type=int,
+                            help='Number of films, persons or rating histories fetched '
+                                 'simultaneously')
+        parser.add_argument('--film-workers', required=False, default=1, type=int,
+                            help='Number of pages of a single film fetched simultaneously')
+        parser.add_argument('--write-buffer', required=False, default=0, type=int,
+                            help='Number of films buffered in memory and written at once')
+        parser.add_argument('--write-interval', required=False, default=60, type=int,
+                            help='Max time in seconds films stay in the write buffer')
+        parser.add_argument('--stat-interval', required=False, default=60, type=int,
+                            help='Interval in seconds between updates of mdb.stat')
+        parser.add_argument('--stat-reconcile', required=False, default=1000, type=int,
+                            help='Number of saved films after which done count is recounted')
+        parser.add_argument('--queue', required=False, default=False, action='store_true',
+                            help='Take listing pages from the shared queue in mdb.task')
+        parser.add_argument('--queue-fill', required=False, default=False, action='store_true',
+                            help='Put listing pages of all years starting from --year '
+                                 'into the queue')
+        parser.add_argument('--lease-time', required=False, default=600, type=int,
+                            help='Time in seconds a leased queue page is reserved for a worker')
+        parser.add_argument('--refresh', required=False, default=False, action='store_true',
+                            help='Revalidate cached pages of films from --from-id to --to-id '
+                                 '(or of --film-id) and save only changed films')
+        parser.add_argument('--budget', required=False, default=None, type=float,
+                            help='Max number of requests per hour for --refresh: films are '
+                                 'refreshed continuously, stale, popular and recent ones first')
+        parser.add_argument('--rating-history', required=False, default=False,
+                            action='store_true',
+                            help='Append new points of rating history of films from --from-id '
+                                 'to --to-id (or of --film-id) to mdb.rating_history')
+        parser.add_argument('--reparse-cache', required=False, default=False,
+                            action='store_true',
+                            help='Rebuild films from --from-id to --to-id from cached pages '
+                                 'without network access, without --to-id all films '
+                                 'from the cache manifest are rebuilt')
+        parser.add_argument('--processes', required=False, default=None, type=int,
+                            help='Number of worker processes for --reparse-cache, '
+                                 'defaults to the number of CPUs')
+        parser.add_argument('--captcha-workers', required=False, default=4, type=int,
+                            help='Max number of captchas solved simultaneously')
+        parser.add_argument('--session-store', required=False, default='file',
+                            choices=['none', 'file', 'db'],
+                            help='Where cookies of solved captchas are shared between workers: '
+                                 'a file in the cache directory for workers of one host '
+                                 'or mdb.session for all hosts')
+        parser.add_argument('--pool-size', required=False, default=None, type=int,
+                            help='Max number of keep-alive connections to the site, defaults '
+                                 'to the number of threads which may fetch pages at once')
+        parser.add_argument('--metrics-port', required=False, default=None, type=int,
+                            help='Port of HTTP server exporting metrics in Prometheus format')
         self.args = parser.parse_args()
 
-        self.cache = FileCache(namespace='kinopoisk', path=os.environ.get('CACHE_PATH'))
-        self.net = NetworkManager()
+        if self.args.metrics_port is not None:
+            metrics.serve(self.args.metrics_port)
+        self.metrics_time = time.time()
+        # Разбор кэша не обращается к сайту, ограничение скорости ему не нужно
+        if self.args.reparse_cache is False:
+            limiter.configure(1 / self.args.sleep_time, self.args.max_rate)
+        if hasattr(config, 'anticaptcha'):
+            captcha.configure(config.anticaptcha['url'], config.anticaptcha['key'],
+                              self.args.captcha_workers)
+
+        self.cache = get_cache()
+        if self.args.session_store == 'file':
+            sessions.configure(FileSessionBackend(os.path.join(self.cache.path, 'session.json')))
+        elif self.args.session_store == 'db':
+            sessions.configure(DatabaseSessionBackend(config.dsn))
+        set_pool_size(self.args.pool_size or
+                      max(10, self.args.concurrency * self.args.film_workers +
+                          self.args.captcha_workers))
+        self.net = get_network_manager()
+        self.listings = OrderedDict()
         # Initialization of database connection
         db.connect(config.dsn)
+        known.load()
+
+        if self.args.write_buffer > 0:
+            self.writer = FilmWriter(self.args.write_buffer, self.args.write_interval,
+                                     on_error=self.log_error)
+        else:
+            self.writer = None
 
         if self.args.year is not None:
             self.set_year(self.args.year)
@@ -65,64 +180,16 @@ class App(BasicParser):
     def set_year(self, year):
         config.year = year
 
-    def get_page_with_captcha(self, page_text):
-        html = fromstring(page_text)
-        # Get captcha image URL
-        img = html.xpath('//div[@class="captcha__image"]//img')
-        captcha_url = img[0].get('src')
-        # Get captcha key
-        input_captcha_key = html.xpath('//input[@class="form__key"]')
-        captcha_key = input_captcha_key[0].get('value')
-        # Get return path
-        input_retpath = html.xpath('//input[@class="form__retpath"]')
-        retpath = input_retpath[0].get('value')
-
-        logger.info('Captcha URL = %s, key = %s' % (captcha_url, captcha_key))
-
-        r = requests.get(captcha_url, stream=True)
-        if r.status_code != 200:
-            raise Exception('Could not download captcha image')
-        captcha_filename = self.cache.get_cached_filename(captcha_url)
-        with open(captcha_filename, 'wb') as f:
-            r.raw.decode_content = True
-            shutil.copyfileobj(r.raw, f)
-
-        solver = CaptchaSolver(captcha_filename)
-        task_id = solver.CreateTask()
-        time.sleep(10)
-        solution = solver.GetTaskResult(task_id)
-        if solution is None:
-            raise GetPageError('Could not solve captcha')
-
-
-        params = {'key': captcha_key, 'retpath': retpath, 'rep': solution}
-        r = requests.get('https://www.kinopoisk.ru/checkcaptcha', params=params)
-        # /checkcaptcha example:
-        # https://www.kinopoisk.ru/checkcaptcha?key=<key>&retpath=<retpath>&rep=%D0%BB%D1%8E%D0%BD%D0%B3%D1%81%D1%82%D0%B0%D0%B4
-        if r.status_code == 200:
-            logger.info('CAPTCHA SOLVED!!!')
-
-        return r
-
-    def is_captcha_required(self, data):
-        if 'captchaimg' in data:
-            raise Exception('Captcha')
-        return 'captchaimg' in data
-
-    def solve_captcha(self, data):
-        self.get_page_with_captcha(data)
-
     def get_rating_history(self, film_id):
         """
         /graph_data/variation_data_film/243/variation_data_film_810243.xml? + Math.random(0,10000)
         """
-        return
+        RatingHistoryLoader(self).load(film_id)
 
     def get_pages_count(self, year, force_download=False):
         logger.info('Getting pages count for year %s' % year)
-        page = self.get_page(self.get_url_for_year(year))
-        html = fromstring(page)
-        a = html.xpath('//div[@class="paginator"]//a[@class="paginator__page-number"][last()]')
+        html = self.get_listing(self.get_url_for_year(year))
+        a = find_last_page(html)
         if a is None or len(a) == 0:
             pages_count = 1
         else:
@@ -131,9 +198,9 @@ class App(BasicParser):
 
         logger.info('Pages count = %s', pages_count)
 
-        div = html.xpath('//div[@class="selections-seo-page__meta-info"]')
+        div = find_meta_info(html)
         if div is not None and len(div) > 0:
-            self.total_count = int(re.sub('[^\d]', '', div[0].text_content()))
+            self.total_count = int(non_digits_regexp.sub('', div[0].text_content()))
         else:
             raise Exception('Could not get total records count!')
 
@@ -141,26 +208,37 @@ class App(BasicParser):
         self.total_pages = pages_count
         return pages_count
 
+    def get_listing(self, url):
+        """
+        Returns parsed listing page. Last pages are kept in memory, so the first
+        page of a year, which is also used to get pages count, is fetched and
+        parsed only once
+        """
+        html = self.listings.pop(url, None)
+        if html is None:
+            html = fromstring(self.get_page(url))
+        self.listings[url] = html
+        if len(self.listings) > self.listings_size:
+            self.listings.popitem(last=False)
+        return html
+
     def get_url_for_year(self, year, page=1):
         return '%s/lists/navigator/%s/?page=%s' % (self.base, year, page,)
 
     def extract_id_from_url(self, url):
-        if re.match('^/film/(\d+)/$', url):
-            # Old URL format
-            # /film/1049041/
-            m = re.search('^/film/(\d+)/$', url)
-            return int(m.group(1))
-        else:
+        # Old URL format
+        # /film/1049041/
+        m = old_film_url_regexp.match(url)
+        if m is None:
             # New URL format
             # /film/pyewacket-2017-1004054/
-            m = re.search('-(\d+)/$', url)
-            return int(m.group(1))
+            m = film_url_regexp.search(url)
+        return int(m.group(1))
 
     def get_films_from_page(self, url, force_download=False):
-        page = self.get_page(url)
-        html = fromstring(page)
-        for item in html.xpath('//div[contains(@class, "selections-film-item")]//a[@class="selection-film-item-meta__link"]'):
-            p = item.xpath('.//p[@class="selection-film-item-meta__name"]')
+        html = self.get_listing(url)
+        for item in find_film_links(html):
+            p = find_film_name(item)
             title = p[0].text_content()
             href = item.get('href')
             id = self.extract_id_from_url(href)
@@ -169,36 +247,128 @@ class App(BasicParser):
     def get_film_url(self, film_id):
         return '%s/film/%s/' % (self.base, film_id,)
 
+    def remove_film_pages(self, film_id, urls):
+        """
+        Removes cached pages of the film: pages listed in the manifest and
+        the pages Film would read, dates and box office pages are found by
+        the full ID from the cached main page
+        """
+        url = self.get_film_url(film_id)
+        cast_url = '%s/film/%s/cast/' % (self.base, film_id,)
+        urls = set(urls) | {url, cast_url, '%s:10000' % cast_url}
+        if self.cache.is_in_cache(url):
+            a = find_subscribe_link(fromstring(self.cache.get_file(url)))
+            m = full_id_regexp.search(a[0].get('href')) if len(a) > 0 else None
+            if m is not None:
+                urls |= {'%s/film/%s/dates/' % (self.base, m.group(1),),
+                         '%s/film/%s/box/' % (self.base, m.group(1),)}
+        for url in sorted(urls):
+            if self.cache.is_in_cache(url):
+                self.cache.remove_from_cache(url)
+
+    def revalidate_film(self, film_id):
+        """
+        Revalidates cached pages of the film, returns True if any of them was
+        changed. Continuation pages of cast requested with POST can not be
+        revalidated, they are removed from the cache to be loaded again when
+        the film has changed.
+        """
+        entries = [(url, page_type) for url, hash, page_type, size
+                   in self.cache.manifest.get_film_entries(film_id) if url.startswith(self.base)]
+        if 'film' not in [page_type for url, page_type in entries]:
+            # Страницы, записанные в кэш до появления манифеста, сверить не с чем:
+            # они удаляются из кэша, чтобы фильм был загружен заново
+            self.remove_film_pages(film_id, [url for url, page_type in entries])
+            return True
+        changed = False
+        continuations = list()
+        for url, page_type in entries:
+            if url.split('/')[-1].startswith(':'):
+                continuations.append(url)
+                continue
+            try:
+                changed = self.revalidate(url) or changed
+            except PageNotFound:
+                # Страница исчезла с сайта, например, у фильма больше нет сборов
+                self.cache.remove_from_cache(url)
+                changed = True
+        if changed:
+            for url in continuations:
+                self.cache.remove_from_cache(url)
+        metrics.inc('films_revalidated_total', result='changed' if changed else 'unchanged')
+        return changed
+
     def get_film(self, film_id):
         """
         Extracts all informarion about film
         """
+        # В режиме --refresh фильм, страницы которого не изменились,
+        # не разбирается и не сохраняется
+        if self.args.refresh is True and not self.revalidate_film(film_id):
+            logger.info('Film %s has not been changed' % film_id)
+            return None
         page = self.get_page(self.get_film_url(film_id))
-        film = Film(film_id, page)
+        film = Film(film_id, page, workers=self.args.film_workers)
 
         logger.info('%s (%s) | %s' % (film.title, film.alternative_title, film.year,))
         return film
 
     def get_current_count(self):
-        return db.query_value('select count(*) from mdb.movie where year = %s' % config.year)
+        return db.query_value('select count(*) from mdb.movie where year = %s', [config.year])
 
     def update_stat(self, last_movie_id):
-        id = db.query_value('select id from mdb.stat where year = %s', [config.year])
-        if id is None:
-            db.execute('insert into mdb.stat (year, done_count, total_count, hostname, '
-                       'last_movie_id, current_page, total_pages) '
-                       'values (%s, %s, %s, %s, %s, %s, %s)',
-                       [config.year, self.get_current_count(), self.total_count,
-                        self.args.hostname, last_movie_id, self.current_page,
-                        self.total_pages])
-        else:
-            db.execute('update mdb.stat set done_count = %s, total_count = %s, hostname = %s, '
-                       'last_update_time = current_timestamp, last_movie_id = %s, '
-                       'current_page = %s, total_pages = %s '
-                       'where year = %s',
-                       [self.get_current_count(), self.total_count, self.args.hostname,
-                        last_movie_id, self.current_page, self.total_pages,
-                        config.year])
+        db.execute('insert into mdb.stat (year, done_count, total_count, hostname, '
+                   'last_movie_id, current_page, total_pages) '
+                   'values (%s, %s, %s, %s, %s, %s, %s) '
+                   'on conflict (year) do update set done_count = excluded.done_count, '
+                   'total_count = excluded.total_count, hostname = excluded.hostname, '
+                   'last_update_time = current_timestamp, '
+                   'last_movie_id = coalesce(excluded.last_movie_id, mdb.stat.last_movie_id), '
+                   'current_page = excluded.current_page, total_pages = excluded.total_pages',
+                   [config.year, self.done_count, self.total_count, self.args.hostname,
+                    last_movie_id, self.current_page, self.total_pages])
+        self.stat_time = time.time()
+
+    def update_metrics(self):
+        """
+        Logs performance figures since the previous call and stores them
+        into mdb.host_stat
+        """
+        summary = metrics.get_summary()
+        logger.warning('%s requests/s, cache hit ratio %s, parse %s ms/film, db %s ms/film, '
+                       '%s films/s, %s captcha pages'
+                       % (summary['requests_per_sec'], summary['cache_hit_ratio'],
+                          summary['parse_ms_per_film'], summary['db_ms_per_film'],
+                          summary['films_per_sec'], summary['captcha'],))
+        if self.args.read_only is False:
+            db.execute('insert into mdb.host_stat (hostname, requests_per_sec, cache_hit_ratio, '
+                       'parse_ms_per_film, db_ms_per_film, films_per_sec, captcha) '
+                       'values (%s, %s, %s, %s, %s, %s, %s) '
+                       'on conflict (hostname) do update set update_time = current_timestamp, '
+                       'requests_per_sec = excluded.requests_per_sec, '
+                       'cache_hit_ratio = excluded.cache_hit_ratio, '
+                       'parse_ms_per_film = excluded.parse_ms_per_film, '
+                       'db_ms_per_film = excluded.db_ms_per_film, '
+                       'films_per_sec = excluded.films_per_sec, captcha = excluded.captcha',
+                       [self.args.hostname, summary['requests_per_sec'],
+                        summary['cache_hit_ratio'], summary['parse_ms_per_film'],
+                        summary['db_ms_per_film'], summary['films_per_sec'],
+                        summary['captcha']])
+        self.metrics_time = time.time()
+
+    def update_progress(self, last_movie_id):
+        """
+        Счётчик обработанных фильмов ведётся в памяти, точное значение
+        пересчитывается раз в --stat-reconcile фильмов, а в mdb.stat
+        записывается не чаще, чем раз в --stat-interval секунд
+        """
+        self.done_count += 1
+        self.saved_count += 1
+        self.last_movie_id = last_movie_id
+        if self.saved_count % self.args.stat_reconcile == 0:
+            self.done_count = self.get_current_count()
+        if time.time() - self.stat_time >= self.args.stat_interval:
+            self.update_stat(last_movie_id)
 
     def update_total(self):
         id = db.query_value('select id from mdb.stat where year = %s', [config.year])
@@ -217,55 +387,188 @@ class App(BasicParser):
                    'values (%s, %s, %s)', [self.args.hostname, movie_id, message])
 
     def is_film_exists(self, movie_id):
+        if known.movies is not None:
+            return movie_id in known.movies
         return db.query_value('select count(*) from mdb.movie where id = %s', [movie_id]) > 0
 
-    def get_year(self, year, update_mode=False):
-        logger.info('======= Processing year %s =======' % year)
+    def get_page_films(self, year, page_number, update_mode=False):
+        """
+        Yields films to process from one listing page
+        """
+        for id, title, href in self.get_films_from_page(self.get_url_for_year(year, page_number),
+                                                        force_download=update_mode):
+            if update_mode:
+                if self.is_film_exists(id) is True:
+                    continue
+                logger.warning('New film found')
+
+            yield (id, title, href)
+
+    def get_year_films(self, year, update_mode=False):
+        """
+        Walks listing pages of the year and yields films to process
+        """
         for page_number in range(self.args.start_page,
                                  self.get_pages_count(year, force_download=update_mode) + 1):
             self.current_page = page_number
             logger.info("Processing page %s" % page_number)
-            for id, title, href in self.get_films_from_page(self.get_url_for_year(year,
-                                                                                  page_number),
-                                                            force_download=update_mode):
-                if update_mode and self.is_film_exists(id) is True:
-                    continue
-                if update_mode and self.is_film_exists(id) is False:
-                    logger.warning('New film found')
+            for film in self.get_page_films(year, page_number, update_mode):
+                yield film
+
+    def save_film(self, f):
+        if self.args.read_only is False:
+            if self.writer is not None:
+                self.writer.add(f)
+            else:
+                f.save()
+        if time.time() - self.metrics_time >= self.args.stat_interval:
+            self.update_metrics()
+        if self.task is not None:
+            # Статистика по годам в режиме очереди не ведётся, прогресс
+            # виден по таблице mdb.task
+            self.queue.heartbeat(self.task)
+            return
+        if self.args.refresh is True:
+            return
+        if self.args.read_only is False:
+            self.update_progress(f.id)
+        logger.warning('%s from %s' % (self.done_count, self.total_count,))
 
+    def call_in_save_thread(self, function, *args):
+        """
+        Runs the function in the thread which saves films, so that the films
+        iterator can query the database while films are being saved
+        """
+        if self.crawler is not None:
+            return self.crawler.call(function, *args)
+        return function(*args)
+
+    def process_films(self, films):
+        """
+        Fetches and saves films yielded by `films` iterator of (id, title, href)
+        """
+        if self.args.concurrency > 1:
+            self.crawler = AsyncCrawler(self, self.args.concurrency)
+            try:
+                self.crawler.run(films)
+            finally:
+                self.crawler = None
+        else:
+            for id, title, href in films:
                 logger.info('%s | %s | %s' % (id, title, href,))
 
-                #try:
-                f = self.get_film(id)
-                if self.args.read_only is False:
-                    f.save()
-                #except Exception as e:
-                #    self.log_error(id, str(e))
-                logger.warning('%s from %s' % (self.get_current_count(), self.total_count,))
-                if self.args.read_only is False:
-                    self.update_stat(id)
+                try:
+                    f = self.get_film(id)
+                    if f is not None:
+                        self.save_film(f)
+                except Exception as e:
+                    self.log_error(id, str(e))
+        if self.writer is not None:
+            self.writer.flush()
+
+    def get_year(self, year, update_mode=False):
+        logger.info('======= Processing year %s =======' % year)
+        self.done_count = self.get_current_count()
+        self.last_movie_id = None
+        self.process_films(self.get_year_films(year, update_mode))
+        if self.args.read_only is False:
+            self.done_count = self.get_current_count()
+            self.update_stat(self.last_movie_id)
+        self.update_metrics()
         # После получения всех страниц года нужно сбросить счётчик страниц,
         # чтобы новый год начинать извлекать всегда с первой страницы
         self.args.start_page = 1
 
-    def update_persons(self):
-        query = "select id from mdb.person " \
-                " where id between %s and coalesce(%s, 999999999) " \
-                "   and parsed_extra = false " \
-                " order by id"
-        for person in db.query_dict(query, [self.args.from_id, self.args.to_id]):
-            logger.info('Parsing person with ID = %s', person['id'])
+    def fill_queue(self):
+        queue = WorkQueue(self.args.hostname, self.args.lease_time)
+        while config.year <= date.today().year + 1:
+            queue.fill(config.year, self.get_pages_count(config.year))
+            self.set_year(config.year + 1)
+
+    def process_queue(self):
+        """
+        Processes listing pages leased from the shared queue until it is empty
+        """
+        self.queue = WorkQueue(self.args.hostname, self.args.lease_time)
+        while True:
+            self.task = self.queue.lease()
+            if self.task is None:
+                wait = self.queue.get_retry_wait()
+                if wait is None:
+                    logger.warning('Queue is empty')
+                    break
+                logger.warning('Waiting %.0f s to retry failed pages' % wait)
+                time.sleep(float(wait) + 1)
+                continue
+            logger.warning('======= Processing year %s, page %s =======' %
+                           (self.task['year'], self.task['page'],))
+            self.set_year(self.task['year'])
+            self.current_page = self.task['page']
             try:
-                person = Person(person['id'])
-                person.save()
+                self.process_films(self.get_page_films(self.task['year'], self.task['page'],
+                                                       update_mode=self.args.update))
             except Exception as e:
-                logger.error('Could not process person %s' % person['id'])
-                self.log_error(person['id'], 'Could not process person: %s' % str(e))
+                self.log_error(None, 'Could not process page %s of year %s: %s' %
+                               (self.task['page'], self.task['year'], str(e),))
+                self.queue.release(self.task)
+                continue
+            self.queue.complete(self.task)
+        self.task = None
+
+    def update_persons(self):
+        updater = PersonUpdater(self, self.args.concurrency, self.args.write_buffer or 100)
+        updater.run(self.args.from_id, self.args.to_id)
+
+    def update_rating_history(self):
+        if self.args.film_id is not None:
+            self.get_rating_history(self.args.film_id)
+            return
+        loader = RatingHistoryLoader(self, self.args.concurrency)
+        loader.run(self.args.from_id, self.args.to_id)
+
+    def refresh_films(self):
+        if self.args.budget is not None and self.args.film_id is None:
+            RefreshScheduler(self, self.args.budget).run(self.args.from_id, self.args.to_id)
+            return
+        if self.args.film_id is not None:
+            ids = [self.args.film_id]
+        else:
+            # Список ID читается целиком до начала обхода, иначе курсор читался бы
+            # из потока обхода, пока соединение занято сохранением фильмов
+            query = "select id from mdb.movie " \
+                    " where id between %s and coalesce(%s, 999999999) " \
+                    " order by id"
+            ids = [row[0] for row in db.query_dict(query, [self.args.from_id, self.args.to_id])]
+        self.process_films((id, None, None) for id in ids)
+        self.update_metrics()
+
+    def reparse_cache(self):
+        if self.args.to_id is not None:
+            ids = range(self.args.from_id, self.args.to_id + 1)
+        elif self.cache.manifest.get_count() > 0:
+            # Без --to-id берём фильмы, главные страницы которых есть в индексе кэша
+            ids = self.cache.manifest.get_film_ids(self.args.from_id)
+        else:
+            raise Exception('--to-id is required for --reparse-cache when cache manifest '
+                            'is empty')
+        reparser = Reparser(config.dsn, self.args.processes,
+                            buffer_size=self.args.write_buffer or 100)
+        saved, failed = reparser.run(ids)
+        logger.warning('Done, %s films saved, %s failed' % (saved, failed,))
 
     def run(self):
         if self.args.persons is True:
             self.update_persons()
             return
+        if self.args.reparse_cache is True:
+            self.reparse_cache()
+            return
+        if self.args.rating_history is True:
+            self.update_rating_history()
+            return
+        if self.args.refresh is True:
+            self.refresh_films()
+            return
         if self.args.total is True:
             logger.warning('======= Updating total stat =======')
             for year in range(1890, date.today().year + 1):
@@ -274,14 +577,24 @@ class App(BasicParser):
                 self.get_pages_count(year)
                 self.update_total()
             return
+        elif self.args.queue_fill is True:
+            self.fill_queue()
+            return
         elif self.args.update is True:
             logger.warning('Running in UPDATE mode')
+            # Большинство фильмов в режиме обновления уже есть в базе, поэтому
+            # их ID проверяются в памяти, а не запросом на каждый фильм
+            known.load_movies()
         elif self.args.film_id is not None:
             logger.warning('======= Processing film %s =======' % self.args.film_id)
             f = self.get_film(self.args.film_id)
             f.save()
             sys.exit(0)
 
+        if self.args.queue is True:
+            self.process_queue()
+            return
+
         while config.year <= date.today().year + 1:
             self.get_year(config.year, update_mode=self.args.update)
             self.set_year(config.year + 1)